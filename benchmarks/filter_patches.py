@@ -0,0 +1,105 @@
+"""
+Benchmark the selection of the most intense patches
+
+`filter_patches` is compared to the implementation sorting the whole ranking
+column, on synthetic catalogues of increasing size, with and without a
+precomputed ranking.
+
+    python benchmarks/filter_patches.py -s 10000 -s 100000 -s 1000000
+"""
+
+import timeit
+
+import click
+import numpy as np
+import pandas as pd
+
+from exseas_explorer.util import filter_patches, ranking_key, ranking_order, top_k
+
+
+def synthetic_catalogue(size: int, seed: int = 0) -> pd.DataFrame:
+    """Random attributes of patches, a third of them not over land"""
+
+    rng = np.random.default_rng(seed)
+    land = rng.random(size) < 2 / 3
+
+    def over_land(values: np.ndarray) -> np.ndarray:
+        return np.where(land, values, np.nan)
+
+    area = rng.lognormal(13, 1, size)
+    mean_ano = rng.normal(0, 3, size)
+    return pd.DataFrame(
+        {
+            "label": np.arange(size),
+            "year": rng.integers(1950, 2021, size),
+            "lonmean": rng.uniform(-180, 180, size),
+            "latmean": rng.uniform(-90, 90, size),
+            "area": area,
+            "land_area": over_land(area * rng.random(size)),
+            "mean_ano": mean_ano,
+            "land_mean_ano": over_land(mean_ano * rng.random(size)),
+            "integrated_ano": area * mean_ano,
+            "land_integrated_ano": over_land(area * mean_ano * rng.random(size)),
+        }
+    )
+
+
+def sort_patches(df, criterion=1, nvals=10, lon_range=[-180, 180]):
+    """Previous implementation, reading the threshold from the sorted column"""
+
+    df = df[(df["lonmean"] >= lon_range[0]) & (df["lonmean"] <= lon_range[1])]
+    df = df[(df["latmean"] >= -90) & (df["latmean"] <= 90)]
+    df = df[(df["year"] >= 1950) & (df["year"] <= 2020)]
+
+    column = [
+        "area",
+        "land_area",
+        "mean_ano",
+        "land_mean_ano",
+        "integrated_ano",
+        "land_integrated_ano",
+    ][criterion - 1]
+    if column.startswith("land"):
+        df = df[~np.isnan(df[column])]
+    values = df[column] if criterion < 3 else np.abs(df[column])
+    return df[values >= np.sort(values)[-nvals]]
+
+
+@click.command()
+@click.option(
+    "-s", "--sizes", multiple=True, type=int, default=[10000, 100000, 1000000]
+)
+@click.option("-n", "--nvals", default=10, type=int, help="Number of patches")
+@click.option("-r", "--repeat", default=5, type=int, help="Number of repetitions")
+def benchmark(sizes: list[int], nvals: int, repeat: int):
+    """Time selecting the most intense patches for all criteria"""
+
+    for size in sizes:
+        df = synthetic_catalogue(size)
+        for criterion in range(1, 7):
+            key = ranking_key(df, criterion)
+            order = ranking_order(df, criterion)
+            selections = {
+                "sort": lambda: sort_patches(df, criterion, nvals, [-90, 90]),
+                "filter_patches": lambda: filter_patches(
+                    df, criterion, nvals, [-90, 90]
+                ),
+                "ranked": lambda: filter_patches(
+                    df, criterion, nvals, [-90, 90], order=order
+                ),
+                # Selection of the ranking values only
+                "np.sort": lambda: np.sort(key[~np.isnan(key)])[-nvals],
+                "top_k": lambda: top_k(key, nvals),
+            }
+            timings = {
+                name: min(timeit.repeat(select, number=1, repeat=repeat))
+                for name, select in selections.items()
+            }
+            click.echo(
+                f"{size:>8} patches, criterion {criterion}: "
+                + ", ".join(f"{name} {t * 1000:7.2f} ms" for name, t in timings.items())
+            )
+
+
+if __name__ == "__main__":
+    benchmark()
@@ -0,0 +1,62 @@
+"""
+Benchmark the startup of a web application worker
+
+Each run imports `exseas_explorer.app` in a fresh interpreter, as a WSGI worker
+does, and reports the time until the module is imported. Runs with a cold layout
+cache remove the cached initial selection first.
+
+    python benchmarks/startup.py -n 10
+    python benchmarks/startup.py -n 10 --cold
+"""
+
+import shutil
+import statistics
+import subprocess
+import sys
+
+import click
+
+SCRIPT = """
+import time
+start = time.perf_counter()
+import exseas_explorer.app as app
+print(time.perf_counter() - start, app.LAYOUT_CACHE_DIR)
+"""
+
+
+def import_app() -> tuple[float, str]:
+    output = subprocess.run(
+        [sys.executable, "-c", SCRIPT], check=True, capture_output=True, text=True
+    ).stdout.split()
+    return float(output[0]), output[1]
+
+
+@click.command()
+@click.option("-n", "--runs", default=5, type=int, help="Number of runs")
+@click.option(
+    "--cold/--warm",
+    default=False,
+    help="Remove the cached initial selection before each run",
+)
+def startup(runs: int, cold: bool):
+    """Time importing the web application in fresh interpreters"""
+
+    # First import to find the layout cache and fill the cache of the system
+    _, layout_cache_dir = import_app()
+
+    times = []
+    for _ in range(runs):
+        if cold:
+            shutil.rmtree(layout_cache_dir, ignore_errors=True)
+        elapsed, _ = import_app()
+        times.append(elapsed)
+
+    click.echo(
+        f"{'cold' if cold else 'warm'} layout cache, {runs} runs: "
+        f"min {min(times):.3f} s, median {statistics.median(times):.3f} s, "
+        f"max {max(times):.3f} s"
+    )
+
+
+if __name__ == "__main__":
+    startup()
@@ -1,24 +1,48 @@
 # Run this app with `python app.py` and
 # visit http://127.0.0.1:8050/ in your web browser.
 
+import getpass
 import hashlib
 import importlib.resources as pkg_resources
+import os
 import pathlib
+import re
+import tempfile
+import urllib.parse
 
 import dash_bootstrap_components as dbc
 import dash_leaflet as dl
 import dash_leaflet.express as dlx
 import flask
-import geopandas
-from dash import Dash, Input, Output, State, dcc, html, no_update
+import pandas as pd
+from dash import (
+    ClientsideFunction,
+    Dash,
+    Input,
+    Output,
+    Patch,
+    State,
+    dcc,
+    html,
+    no_update,
+)
 from dash_extensions.javascript import Namespace
 
+from exseas_explorer.cache import ResultCache, file_signature, private_directory
+from exseas_explorer.catalogue import ZOOM_LEVELS, zoom_level
 from exseas_explorer.util import (
+    CATALOGUE_CACHE,
+    attach_geometries,
+    catalogue_version,
+    feature_collection,
     filter_patches,
     generate_cbar,
     generate_poly,
     generate_table,
-    load_patches,
+    load_attributes,
+    load_layout,
+    load_ranking,
+    warm_up,
 )
 
 # allow arbitrary locations if exseas_explorer is installed and
@@ -31,6 +55,19 @@ if not DATA_DIR.is_dir():
     except ModuleNotFoundError as e:
         raise ValueError("Install exseas_explorer or fix data path") from e
 
+# Generated files are cached outside of DATA_DIR, which may be read-only, in a
+# directory only accessible by the user running the application
+CACHE_DIR = pathlib.Path(
+    os.environ.get(
+        "EXSEAS_EXPLORER_CACHE_DIR",
+        pathlib.Path(tempfile.gettempdir()) / f"exseas_explorer-{getpass.getuser()}",
+    )
+)
+TILE_CACHE_DIR = CACHE_DIR / "tiles"
+LAYOUT_CACHE_DIR = CACHE_DIR / "layout"
+RESULT_CACHE_DIR = CACHE_DIR / "results"
+CATALOGUE_NAME = re.compile(r"patches_\w+")
+
 ns = Namespace("myNamespace", "mySubNamespace")
 
 # OPTIONS
@@ -38,6 +75,16 @@ MIN_YEAR = 1950
 MAX_YEAR = 2020
 MIN_NUM_EVENTS = 1
 MAX_NUM_EVENTS = 20
+DEFAULT_ZOOM = 2.5
+CACHE_BYTES = 2**30  # memory budget for catalogues cached by each worker
+RESULT_MEMORY_BYTES = 64 * 2**20  # selections cached by each worker
+RESULT_DISK_BYTES = 512 * 2**20  # selections cached on disk for all workers
+RESULT_TTL = 24 * 3600  # seconds
+TILE_CACHE_BYTES = 2**30  # tiles cached on disk for all workers
+CLIENT_FILTERING = False  # send all patches of a catalogue once, select in browser
+GEOJSON_MAX_AGE = 24 * 3600  # seconds browsers cache patches sent to the map
+WARM_UP = True  # preload all catalogues in the background at startup
+WARM_UP_WORKERS = 4
 lon_range: list[float] = [-180, 180]
 lat_range: list[float] = [-90, 90]
 DEFAULT_SETTING = "patches_T2M_djf_ProbCold"
@@ -122,11 +169,19 @@ as well as to their
 
 
 # LOAD DEFAULT PATCHES
-default_patches = load_patches(str(DATA_DIR / f"{DEFAULT_SETTING}.geojson"))
-default_patches, event_title = filter_patches(default_patches)
-classes = list(default_patches["label"])
-colorscale = generate_cbar(list(default_patches["year"]))
-poly_table = generate_table(default_patches, colorscale, classes)
+CATALOGUE_CACHE.resize(CACHE_BYTES)
+private_directory(str(CACHE_DIR))
+RESULT_CACHE = ResultCache(
+    str(RESULT_CACHE_DIR), RESULT_MEMORY_BYTES, RESULT_DISK_BYTES, RESULT_TTL
+)
+default_layout = load_layout(
+    str(DATA_DIR / f"{DEFAULT_SETTING}.geojson"),
+    zoom_level(DEFAULT_ZOOM),
+    str(LAYOUT_CACHE_DIR),
+)
+classes = default_layout["classes"]
+colorscale = default_layout["colorscale"]
+poly_table = default_layout["table"]
 
 # POLYGON STYLE DEFINITIONS
 style = dict(fillOpacity=0.5, weight=2)
@@ -346,7 +401,7 @@ maprow = html.Div(
                     [
                         dl.Map(
                             center=[0, 0],
-                            zoom=2.5,
+                            zoom=DEFAULT_ZOOM,
                             worldCopyJump=True,
                             minZoom=2,
                             zoomSnap=0.25,
@@ -365,18 +420,21 @@ maprow = html.Div(
                                     zoomToBounds=True,
                                 ),
                                 dl.GeoJSON(
-                                    data=default_patches.__geo_interface__,
+                                    data=default_layout["patches"],
                                     id="patches",
                                     options=dict(
                                         style=ns("color_polys"),
                                         onEachFeature=ns("bindPopup"),
+                                        filter=ns("filter_patches"),
                                     ),
                                     hideout=hideout_dict,
                                 ),
                                 dl.LayerGroup(id="cbar", children=[]),
                             ],
                             id="map",
-                        )
+                        ),
+                        # level of simplified geometries shown on the map
+                        dcc.Store(id="zoom-level", data=zoom_level(DEFAULT_ZOOM)),
                     ],
                     id="map_column",
                 ),
@@ -467,39 +525,32 @@ app = Dash(
 app.layout = html.Div([header, navbar, maprow])
 
 
-@app.callback(
+# Callbacks only changing the user interface run in the browser, see
+# assets/callbacks.js
+app.clientside_callback(
+    ClientsideFunction(namespace="clientside", function_name="subset_region"),
     Output("longitude-selector", "value"),
     Output("latitude-selector", "value"),
     Input("region-selector", "value"),
 )
-def subset_region(region_value: str):
-    if region_value == "world":
-        longitude_range = [-180, 180]
-        latitude_range = [-90, 90]
-    elif region_value == "nh":
-        longitude_range = [-180, 180]
-        latitude_range = [0, 90]
-    elif region_value == "sh":
-        longitude_range = [-180, 180]
-        latitude_range = [-90, 0]
-    elif region_value == "europe":
-        longitude_range = [-20, 30]
-        latitude_range = [30, 80]
-    elif region_value == "asia":
-        longitude_range = [40, 180]
-        latitude_range = [10, 80]
-    elif region_value == "na":
-        longitude_range = [-170, -50]
-        latitude_range = [20, 80]
-    else:
-        longitude_range = [-180, 180]
-        latitude_range = [-90, 90]
 
-    return longitude_range, latitude_range
+
+@app.callback(
+    Output("zoom-level", "data"),
+    Input("map", "zoom"),
+    State("zoom-level", "data"),
+)
+def update_zoom_level(zoom, level):
+    # Only redraw patches when another level of simplified geometries is needed
+    new_level = zoom_level(zoom)
+    if new_level == level:
+        return no_update
+    return new_level
 
 
 @app.callback(
     Output("patches", "data"),
+    Output("patches", "url"),
     Output("patches", "hideout"),
     Output("option-selector", "options"),
     Output("option-selector", "value"),
@@ -516,6 +567,7 @@ def subset_region(region_value: str):
     Input("longitude-selector", "value"),
     Input("latitude-selector", "value"),
     Input("year-selector", "value"),
+    Input("zoom-level", "data"),
 )
 def draw_patches(
     parameter_value,
@@ -526,6 +578,7 @@ def draw_patches(
     longitude_values,
     latitude_values,
     year_values,
+    level,
 ):
     parameter_options = PARAMETER_OPTIONS[parameter_value]
 
@@ -538,7 +591,27 @@ def draw_patches(
 
     # Load patches
     selected_patch = f"patches_{parameter_value}_{season_value}_{option_selected}"
-    patches = load_patches(str(DATA_DIR / f"{selected_patch}.geojson"))
+    patch_path = str(DATA_DIR / f"{selected_patch}.geojson")
+
+    # Users mostly hit the same selections, which only depend on the normalized
+    # inputs and the version of the catalogue
+    key = ResultCache.key(
+        selected_patch,
+        parameter_option,
+        nval_value,
+        ranking_option,
+        tuple(float(value) for value in longitude_values),
+        tuple(float(value) for value in latitude_values),
+        tuple(float(value) for value in year_values),
+        level,
+        catalogue_version(patch_path),
+        file_signature([__file__]),
+    )
+    result = RESULT_CACHE.get(key)
+    if result is not None:
+        return result
+
+    patches = load_attributes(patch_path)
 
     patches, event_title = filter_patches(
         patches,
@@ -547,6 +620,7 @@ def draw_patches(
         longitude_values,
         latitude_values,
         year_values,
+        order=load_ranking(patch_path, ranking_option),
     )
 
     # Check if number of values was modified due to filtering
@@ -555,12 +629,15 @@ def draw_patches(
     else:
         max_events = MAX_NUM_EVENTS
 
-    # Catch situations where no events remain
+    # Catch situations where no events remain, the map hides patches that are not
+    # selected
     if max_events == 0:
+        hideout_dict = Patch()
+        hideout_dict["classes"] = []
         return (
-            {"type": "FeatureCollection", "features": []},
             no_update,
             no_update,
+            hideout_dict,
             no_update,
             no_update,
             no_update,
@@ -599,8 +676,22 @@ def draw_patches(
         patches, colorscale, classes, ranking_option, parameter_value, parameter_option
     )
 
-    return (
-        patches.__geo_interface__,
+    # The map fetches the patches, with geometries simplified for its zoom, from
+    # their features encoded once per catalogue. With client filtering, it fetches
+    # all patches of the catalogue once and only the selected labels change.
+    version = hashlib.sha1(repr(catalogue_version(patch_path)).encode())
+    query = {"v": version.hexdigest()[:8]}
+    if not CLIENT_FILTERING:
+        query["labels"] = ",".join(str(label) for label in classes)
+    if level is not None:
+        query["level"] = str(level)
+    url = app.get_relative_path(
+        f"/geojson/{selected_patch}.geojson?{urllib.parse.urlencode(query)}"
+    )
+
+    result = (
+        None,
+        url,
         hideout_dict,
         parameter_options,
         option_selected,
@@ -610,6 +701,9 @@ def draw_patches(
         max_events,
         event_title,
     )
+    RESULT_CACHE.put(key, result)
+
+    return result
 
 
 @app.callback(
@@ -632,17 +726,24 @@ def show_netcdf_download(
 
 @app.callback(
     Output("download-json-component", "data"),
-    State("patches", "data"),
+    State("patches", "hideout"),
     State("parameter-selector", "value"),
     State("option-selector", "value"),
     State("season-selector", "value"),
     Input("download-json", "n_clicks"),
     prevent_initial_call=True,
 )
-def download_geojson(patches, parameter_value, parameter_option, season_value, _):
-    gdf = geopandas.GeoDataFrame.from_features(patches)
-    gdf = gdf.drop(columns=["visited on", "what"])
-    geojson = gdf.to_json()
+def download_geojson(hideout, parameter_value, parameter_option, season_value, _):
+    # The map may show simplified geometries, download them at full resolution
+    selected_patch = f"patches_{parameter_value}_{season_value}_{parameter_option}"
+    patch_path = str(DATA_DIR / f"{selected_patch}.geojson")
+    attributes = load_attributes(patch_path)
+    # The hideout may still hold labels of the previous catalogue, which are left
+    # out
+    rows = pd.Index(attributes["label"]).get_indexer(hideout["classes"])
+    gdf = attach_geometries(attributes.iloc[rows[rows >= 0]], patch_path, None)
+    gdf = gdf.rename(columns={"year": "Year"}).drop(columns=["visited on", "what"])
+    geojson = gdf.reset_index(drop=True).to_json()
 
     # the filename should be the same, given the same patches
     hash = hashlib.sha1(geojson.encode("utf-8")).hexdigest()[:8]
@@ -654,7 +755,8 @@ def download_geojson(patches, parameter_value, parameter_option, season_value, _
     return dcc.send_string(geojson, filename=filename)
 
 
-@app.callback(
+app.clientside_callback(
+    ClientsideFunction(namespace="clientside", function_name="toggle_sidebar"),
     Output("sidebar_column", "style"),
     Output("toggle-sidebar", "style"),
     Output("toggle-sidebar", "children"),
@@ -663,30 +765,14 @@ def download_geojson(patches, parameter_value, parameter_option, season_value, _
     Input("toggle-sidebar", "style"),
     Input("toggle-sidebar", "children"),
 )
-def toggle_sidebar(n_clicks, sidebar_style, toggle_style, button):
-    if n_clicks:
-        if sidebar_style["display"] == "none":
-            sidebar_style["display"] = "flex"
-            toggle_style["right"] = "260px"
-            button = ["❯"]
-        else:
-            sidebar_style["display"] = "none"
-            toggle_style["right"] = "10px"
-            button = ["❮"]
-        return sidebar_style, toggle_style, button
 
-    return sidebar_style, toggle_style, button
 
-
-@app.callback(
+app.clientside_callback(
+    ClientsideFunction(namespace="clientside", function_name="toggle_modal"),
     Output("modal", "is_open"),
     [Input("open", "n_clicks"), Input("close", "n_clicks")],
     [State("modal", "is_open")],
 )
-def toggle_modal(n1, n2, is_open):
-    if n1 or n2:
-        return not is_open
-    return is_open
 
 
 @app.server.route("/data/<path:path>")
@@ -694,7 +780,78 @@ def serve_static(path):
     return flask.send_from_directory(DATA_DIR, path)
 
 
+@app.server.route("/tiles/<catalogue>/<int:z>/<int:x>/<int:y>.pbf")
+def serve_tile(catalogue, z, x, y):
+    from exseas_explorer import tiles
+
+    # Only serve tiles of existing catalogues in DATA_DIR
+    path = DATA_DIR / f"{catalogue}.geojson"
+    if not CATALOGUE_NAME.fullmatch(catalogue) or not path.is_file():
+        flask.abort(404)
+    if not (0 <= z <= tiles.MAX_ZOOM and 0 <= x < 2**z and 0 <= y < 2**z):
+        flask.abort(404)
+
+    # Selected patches are passed as comma separated labels
+    try:
+        labels = [
+            int(label)
+            for label in flask.request.args.get("labels", "").split(",")
+            if label
+        ]
+    except ValueError:
+        flask.abort(400)
+
+    tile = tiles.load_tile(
+        str(path), z, x, y, labels, str(TILE_CACHE_DIR), TILE_CACHE_BYTES
+    )
+    return flask.Response(tile, mimetype="application/vnd.mapbox-vector-tile")
+
+
+@app.server.route("/geojson/<catalogue>.geojson")
+def serve_geojson(catalogue):
+    # Only serve patches of existing catalogues in DATA_DIR
+    path = DATA_DIR / f"{catalogue}.geojson"
+    if not CATALOGUE_NAME.fullmatch(catalogue) or not path.is_file():
+        flask.abort(404)
+
+    # Selected patches are passed as comma separated labels, all patches are sent
+    # without labels
+    labels = None
+    if "labels" in flask.request.args:
+        try:
+            labels = [
+                int(label) for label in flask.request.args["labels"].split(",") if label
+            ]
+        except ValueError:
+            flask.abort(400)
+    level = flask.request.args.get("level", type=int)
+    if level not in [None, *ZOOM_LEVELS]:
+        flask.abort(400)
+
+    geojson = feature_collection(str(path), labels, level)
+    response = flask.Response(geojson, mimetype="application/geo+json")
+
+    # URLs include the version of the catalogue, responses can be reused
+    if "v" in flask.request.args:
+        response.cache_control.public = True
+        response.cache_control.max_age = GEOJSON_MAX_AGE
+
+    return response
+
+
+@app.server.route("/cache")
+def cache_stats():
+    return flask.jsonify(
+        catalogues=CATALOGUE_CACHE.stats(), results=RESULT_CACHE.stats()
+    )
+
+
 server = app.server
 
+# Other catalogues are loaded while the server already accepts requests, started
+# last so that it does not slow down importing this module
+if WARM_UP:
+    warm_up(sorted(str(p) for p in DATA_DIR.glob("patches_*.geojson")), WARM_UP_WORKERS)
+
 if __name__ == "__main__":
     app.run(debug=True, port=8050)
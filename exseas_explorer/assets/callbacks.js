@@ -0,0 +1,39 @@
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    clientside: {
+        subset_region: function (region_value) {
+            // longitude and latitude ranges of the regions
+            const regions = {
+                world: [[-180, 180], [-90, 90]],
+                nh: [[-180, 180], [0, 90]],
+                sh: [[-180, 180], [-90, 0]],
+                europe: [[-20, 30], [30, 80]],
+                asia: [[40, 180], [10, 80]],
+                na: [[-170, -50], [20, 80]]
+            };
+            return regions[region_value] || regions.world;
+        },
+        toggle_sidebar: function (n_clicks, sidebar_style, toggle_style, button) {
+            if (n_clicks) {
+                // return new objects, dash does not detect changes of its inputs
+                sidebar_style = Object.assign({}, sidebar_style);
+                toggle_style = Object.assign({}, toggle_style);
+                if (sidebar_style.display == "none") {
+                    sidebar_style.display = "flex";
+                    toggle_style.right = "260px";
+                    button = ["❯"];
+                } else {
+                    sidebar_style.display = "none";
+                    toggle_style.right = "10px";
+                    button = ["❮"];
+                }
+            }
+            return [sidebar_style, toggle_style, button];
+        },
+        toggle_modal: function (n1, n2, is_open) {
+            if (n1 || n2) {
+                return !is_open;
+            }
+            return is_open;
+        }
+    }
+});
@@ -16,6 +16,10 @@ window.myNamespace = Object.assign({}, window.myNamespace, {
             }
             return style;
         },
+        filter_patches: function (feature, context) {
+            const { classes } = context.hideout;
+            return classes.includes(feature.properties.label); // only show selected patches
+        },
         bindPopup: function (feature, layer, context) {
             const { parameter } = context.hideout;
             const props = feature.properties;
@@ -0,0 +1,656 @@
+"""
+Memory bounded caches of catalogues loaded from disk and of computed results
+"""
+
+import contextlib
+import hashlib
+import logging
+import os
+import pickle
+import stat
+import sys
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import Callable, Hashable, Sequence
+from concurrent.futures import Future
+from typing import Any
+
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+# Bytes per coordinate pair of a geometry
+COORDINATE_BYTES = 16
+
+
+def file_signature(paths: Sequence[str]) -> tuple:
+    """
+    Size and modification time of files, None for files that do not exist
+
+    Parameters
+    ----------
+    paths : sequence of str
+        Paths to the files
+
+    Returns
+    -------
+    tuple
+        Signature that changes whenever one of the files is replaced
+    """
+
+    signature: list[tuple[int, int] | None] = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            signature.append(None)
+        else:
+            signature.append((stat.st_size, stat.st_mtime_ns))
+
+    return tuple(signature)
+
+
+def private_directory(path: str) -> str:
+    """
+    Create a directory only accessible by the current user, or check that an
+    existing directory is
+
+    Parameters
+    ----------
+    path : str
+        Path to the directory
+
+    Returns
+    -------
+    str
+        Path to the directory
+
+    Raises
+    ------
+    PermissionError
+        If the directory belongs to another user or other users can access it
+    """
+
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    info = os.lstat(path)
+    if (
+        not stat.S_ISDIR(info.st_mode)
+        or info.st_uid != os.getuid()
+        or info.st_mode & 0o077
+    ):
+        raise PermissionError(
+            f"{path} must be a directory only accessible by the current user"
+        )
+
+    return path
+
+
+def read_private(path: str) -> bytes:
+    """
+    Read a file owned by the current user that other users cannot modify, such
+    as a pickle written by this application
+
+    Parameters
+    ----------
+    path : str
+        Path to the file
+
+    Returns
+    -------
+    bytes
+        Content of the file
+
+    Raises
+    ------
+    PermissionError
+        If the file belongs to another user or other users can modify it
+    """
+
+    with open(path, "rb") as in_file:
+        info = os.fstat(in_file.fileno())
+        if info.st_uid != os.getuid() or info.st_mode & 0o022:
+            raise PermissionError(f"{path} may have been written by another user")
+        return in_file.read()
+
+
+def write_private(path: str, data: bytes) -> None:
+    """
+    Write a file only the current user can read and modify, whatever the umask
+
+    The file is written next to its destination and moved in place, so that
+    other processes never read a partial file.
+
+    Parameters
+    ----------
+    path : str
+        Path to the file
+    data : bytes
+        Content of the file
+    """
+
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    # Left behind by a process that had the same identifiers
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(tmp_path)
+
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    try:
+        with os.fdopen(fd, "wb") as out_file:
+            out_file.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(tmp_path)
+        raise
+
+
+def prune_directory(
+    path: str,
+    max_bytes: int,
+    ttl: float | None = None,
+    suffix: str = "",
+    target_bytes: int | None = None,
+) -> int:
+    """
+    Remove the oldest files of a directory tree beyond a budget, expired files
+    and emptied directories
+
+    Other processes may write and remove files in the same directory at the
+    same time.
+
+    Parameters
+    ----------
+    path : str
+        Path to the directory
+    max_bytes : int
+        Budget of the files in bytes
+    ttl : float, optional
+        Time to live of the files in seconds, files do not expire if not given
+    suffix : str, default: ""
+        Suffix of the files that are counted and removed
+    target_bytes : int, optional
+        Bytes of files kept once the budget is exceeded, `max_bytes` if not
+        given
+
+    Returns
+    -------
+    int
+        Bytes of the remaining files
+    """
+
+    if target_bytes is None:
+        target_bytes = max_bytes
+
+    now = time.time()
+    files = []
+    for root, _, names in os.walk(path):
+        for name in names:
+            if not name.endswith(suffix):
+                continue
+            file_path = os.path.join(root, name)
+            try:
+                info = os.stat(file_path)
+            except FileNotFoundError:
+                continue
+            files.append((info.st_mtime, info.st_size, file_path))
+
+    total = sum(size for _, size, _ in files)
+    exceeded = total > max_bytes
+    for mtime, size, file_path in sorted(files):
+        expired = ttl is not None and now - mtime >= ttl
+        if not expired and (not exceeded or total <= target_bytes):
+            continue
+        try:
+            os.remove(file_path)
+        except FileNotFoundError:
+            pass
+        total -= size
+
+    for root, _, _ in os.walk(path, topdown=False):
+        if root != path:
+            try:
+                os.rmdir(root)
+            except OSError:
+                # Not empty
+                pass
+
+    return total
+
+
+class DiskBudget:
+    """
+    Budget of the files written to a directory tree by several processes
+
+    Walking the tree is expensive, so each process keeps an estimate of its
+    size, adding the files it writes, and only prunes the tree once the estimate
+    exceeds the budget. Pruning removes the oldest files until `low_water` of the
+    budget remains, so that the tree is walked once per that share of the budget
+    written. Each process may exceed the budget by up to that share before
+    noticing writes of other processes.
+
+    Parameters
+    ----------
+    path : str
+        Path to the directory
+    max_bytes : int
+        Budget of the files in bytes
+    ttl : float, optional
+        Time to live of the files in seconds, files do not expire if not given
+    suffix : str, default: ""
+        Suffix of the files that are counted and removed
+    low_water : float, default: 0.9
+        Share of the budget kept when pruning
+    """
+
+    def __init__(
+        self,
+        path: str,
+        max_bytes: int,
+        ttl: float | None = None,
+        suffix: str = "",
+        low_water: float = 0.9,
+    ):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.suffix = suffix
+        self.low_water = low_water
+        self.prunes = 0
+        # Unknown until the tree is walked for the first time
+        self._estimate: int | None = None
+        self._pruning = False
+        self._lock = threading.Lock()
+
+    def add(self, size: int) -> None:
+        """
+        Account for a file written to the tree, pruning the tree if needed
+
+        Parameters
+        ----------
+        size : int
+            Size of the file in bytes
+        """
+
+        with self._lock:
+            if self._estimate is not None:
+                self._estimate += size
+                if self._estimate <= self.max_bytes:
+                    return
+            # Another thread is already pruning the tree
+            if self._pruning:
+                return
+            self._pruning = True
+
+        try:
+            remaining = prune_directory(
+                self.path,
+                self.max_bytes,
+                self.ttl,
+                self.suffix,
+                int(self.max_bytes * self.low_water),
+            )
+        finally:
+            with self._lock:
+                self._pruning = False
+
+        with self._lock:
+            self._estimate = remaining
+            self.prunes += 1
+
+
+def memory_size(value: Any) -> int:
+    """
+    Approximate memory used by a data frame or series, including the coordinates
+    of its geometries
+
+    Other values, such as memory-mapped files shared between processes, are
+    counted by their own size only.
+
+    Parameters
+    ----------
+    value : Any
+        Cached value
+
+    Returns
+    -------
+    int
+        Size in bytes
+    """
+
+    if isinstance(value, pd.Series):
+        value = value.to_frame()
+    elif not isinstance(value, pd.DataFrame):
+        return sys.getsizeof(value)
+
+    size = int(value.memory_usage(deep=True).sum())
+    for column in value.columns:
+        if value[column].dtype.name == "geometry":
+            import shapely
+
+            coordinates = shapely.get_num_coordinates(value[column].values).sum()
+            size += int(coordinates) * COORDINATE_BYTES
+
+    return size
+
+
+class CatalogueCache:
+    """
+    Least recently used cache of values loaded from files, bounded by the memory
+    used by the values
+
+    Values are reloaded whenever the size or modification time of the files they
+    were loaded from changes. Concurrent requests for a value that is not cached
+    are coalesced: one thread loads it and the others wait for its result.
+
+    Parameters
+    ----------
+    max_bytes : int
+        Memory budget of the cache in bytes
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.coalesced = 0
+        self._loading: dict[Hashable, tuple[tuple, Future]] = {}
+        self._entries: OrderedDict[Hashable, tuple[tuple, Any, int]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, paths: Sequence[str], load: Callable[[], Any]) -> Any:
+        """
+        Get a value from the cache, loading it if it is missing or outdated
+
+        Parameters
+        ----------
+        key : hashable
+            Key of the value
+        paths : sequence of str
+            Files the value is loaded from
+        load : callable
+            Function loading the value
+
+        Returns
+        -------
+        Any
+            Cached or loaded value
+        """
+
+        signature = file_signature(paths)
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == signature:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+
+            # Wait for another thread already loading the same value
+            loading = self._loading.get(key)
+            if loading is not None and loading[0] == signature:
+                self.coalesced += 1
+                future = loading[1]
+            else:
+                self.misses += 1
+                future = Future()
+                self._loading[key] = (signature, future)
+                loading = None
+
+        if loading is not None:
+            return future.result()
+
+        try:
+            value = load()
+        except BaseException as e:
+            with self._lock:
+                self._finish(key, future)
+            future.set_exception(e)
+            raise
+
+        size = memory_size(value)
+
+        with self._lock:
+            self._finish(key, future)
+            self._remove(key)
+            if size <= self.max_bytes:
+                self._entries[key] = (signature, value, size)
+                self.current_bytes += size
+                self._evict()
+            else:
+                logger.warning(f"{key} exceeds the cache budget, it is not cached")
+
+        future.set_result(value)
+        return value
+
+    def resize(self, max_bytes: int) -> None:
+        """
+        Change the memory budget of the cache, evicting values if needed
+
+        Parameters
+        ----------
+        max_bytes : int
+            Memory budget of the cache in bytes
+        """
+
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def clear(self) -> None:
+        """
+        Remove all values from the cache and reset its counters
+        """
+
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+            self.hits = self.misses = self.evictions = self.coalesced = 0
+
+    def stats(self) -> dict[str, int]:
+        """
+        Counters of the cache
+
+        Returns
+        -------
+        dict
+            Number of hits, misses, evictions, requests coalesced with a load in
+            progress and cached values, and the memory used by the cached values
+            in bytes
+        """
+
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "coalesced": self.coalesced,
+                "entries": len(self._entries),
+                "bytes": self.current_bytes,
+                "max_bytes": self.max_bytes,
+            }
+
+    def _finish(self, key: Hashable, future: Future) -> None:
+        # A newer load of the same key may have replaced this one
+        loading = self._loading.get(key)
+        if loading is not None and loading[1] is future:
+            del self._loading[key]
+
+    def _remove(self, key: Hashable) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.current_bytes -= entry[2]
+
+    def _evict(self) -> None:
+        # Evict the least recently used values until the budget is met
+        while self.current_bytes > self.max_bytes and self._entries:
+            _, (_, _, size) = self._entries.popitem(last=False)
+            self.current_bytes -= size
+            self.evictions += 1
+
+
+class ResultCache:
+    """
+    Two-tier cache of computed results, held in memory by each process and
+    stored on disk for all processes
+
+    The in-process tier evicts the least recently used results and the on-disk
+    tier the oldest results. Both are bounded in bytes, measured by the size of
+    the pickled results, and results expire after a time to live. Keys should
+    include the version of the data the results are computed from.
+
+    Results are pickled, so they are only read from a private directory and
+    from files written by the current user.
+
+    Parameters
+    ----------
+    cache_dir : str
+        Directory only accessible by the current user in which results are
+        stored, shared by all processes
+    memory_bytes : int
+        Memory budget of the in-process tier in bytes
+    disk_bytes : int
+        Budget of the on-disk tier in bytes
+    ttl : float
+        Time to live of the results in seconds
+    """
+
+    def __init__(self, cache_dir: str, memory_bytes: int, disk_bytes: int, ttl: float):
+        self.cache_dir = private_directory(cache_dir)
+        self.disk = DiskBudget(self.cache_dir, disk_bytes, ttl, ".pkl")
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self.ttl = ttl
+        self.current_bytes = 0
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[str, tuple[float, Any, int]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(*parts: Hashable) -> str:
+        """
+        Digest of the normalized parts of a key
+
+        Parameters
+        ----------
+        *parts : hashable
+            Inputs and data version the result depends on
+
+        Returns
+        -------
+        str
+            Key of the result
+        """
+
+        return hashlib.sha1(repr(parts).encode()).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.pkl")
+
+    def get(self, key: str) -> Any:
+        """
+        Get a result from memory or from disk
+
+        Parameters
+        ----------
+        key : str
+            Key of the result
+
+        Returns
+        -------
+        Any
+            Cached result, None if it is not cached or expired
+        """
+
+        now = time.time()
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and now - entry[0] < self.ttl:
+                self._entries.move_to_end(key)
+                self.memory_hits += 1
+                return entry[1]
+
+        path = self._path(key)
+        try:
+            created = os.path.getmtime(path)
+            if now - created >= self.ttl:
+                raise FileNotFoundError(path)
+            data = read_private(path)
+            value = pickle.loads(data)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            with self._lock:
+                self.misses += 1
+            return None
+
+        with self._lock:
+            self.disk_hits += 1
+            self._store(key, created, value, len(data))
+
+        return value
+
+    def put(self, key: str, value: Any) -> None:
+        """
+        Store a result in memory and on disk
+
+        Parameters
+        ----------
+        key : str
+            Key of the result
+        value : Any
+            Result, which must be picklable
+        """
+
+        data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+
+        with self._lock:
+            self._store(key, time.time(), value, len(data))
+
+        if len(data) > self.disk_bytes:
+            return
+
+        # Written atomically, other processes may read the result at the same time
+        private_directory(self.cache_dir)
+        write_private(self._path(key), data)
+
+        self.disk.add(len(data))
+
+    def stats(self) -> dict[str, float]:
+        """
+        Counters of the cache
+
+        Returns
+        -------
+        dict
+            Number of hits in memory and on disk, misses, hit rate and number
+            and size in bytes of the results held in memory
+        """
+
+        with self._lock:
+            requests = self.memory_hits + self.disk_hits + self.misses
+            hits = self.memory_hits + self.disk_hits
+            return {
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": hits / requests if requests else 0.0,
+                "entries": len(self._entries),
+                "bytes": self.current_bytes,
+            }
+
+    def _store(self, key: str, created: float, value: Any, size: int) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.current_bytes -= entry[2]
+        if size > self.memory_bytes:
+            return
+
+        self._entries[key] = (created, value, size)
+        self.current_bytes += size
+        while self.current_bytes > self.memory_bytes:
+            _, (_, _, evicted) = self._entries.popitem(last=False)
+            self.current_bytes -= evicted
@@ -0,0 +1,508 @@
+"""
+Reading and writing of extreme season patch catalogues
+"""
+
+from __future__ import annotations
+
+import json
+import os
+import struct
+from collections.abc import Callable
+from contextlib import AbstractContextManager, nullcontext
+from typing import TYPE_CHECKING, Any
+
+import numpy as np
+import pandas as pd
+
+# Geometry libraries are slow to import and only imported when needed
+if TYPE_CHECKING:
+    import geopandas
+
+# Columns holding literature references, dictionaries indexed by reference
+LITERATURE_COLUMNS = ["author", "link", "visited on", "what"]
+
+# Zoom levels of the map for which simplified geometries are stored, patches are
+# shown at full resolution beyond the last level
+ZOOM_LEVELS = [2, 3, 4]
+
+# Alignment of the columns in the memory-mapped columnar file
+COLUMN_ALIGNMENT = 64
+
+
+def simplify_tolerance(level: int) -> float:
+    """
+    Tolerance used to simplify geometries for a zoom level of the map, which is
+    the width of a screen pixel in degrees
+
+    Parameters
+    ----------
+    level : int
+        Zoom level of the map
+
+    Returns
+    -------
+    float
+        Tolerance in degrees
+    """
+
+    return 360 / (256 * 2**level)
+
+
+def zoom_level(zoom: float | None) -> int | None:
+    """
+    Select the level of simplified geometries matching a zoom of the map
+
+    Parameters
+    ----------
+    zoom : float or None
+        Current zoom of the map
+
+    Returns
+    -------
+    int or None
+        Zoom level of the simplified geometries, None for full resolution
+    """
+
+    if zoom is None:
+        return ZOOM_LEVELS[0]
+
+    for level in ZOOM_LEVELS:
+        if zoom < level + 1:
+            return level
+
+    return None
+
+
+def simplify_catalogue(patches: geopandas.GeoDataFrame) -> geopandas.GeoDataFrame:
+    """
+    Simplify the geometries of patches for all zoom levels
+
+    Parameters
+    ----------
+    patches : geopandas.GeoDataFrame
+        Patches at full resolution
+
+    Returns
+    -------
+    geopandas.GeoDataFrame
+        Simplified geometries of all patches, one row per patch and zoom level in
+        the order of the patches
+    """
+
+    import geopandas
+    import shapely
+
+    levels = []
+    for level in ZOOM_LEVELS:
+        geometries = shapely.simplify(
+            patches.geometry.values, simplify_tolerance(level), preserve_topology=True
+        )
+        levels.append(
+            geopandas.GeoDataFrame(
+                {"label": patches["label"].values, "zoom": level},
+                geometry=geometries,
+                crs=patches.crs,
+            )
+        )
+
+    return pd.concat(levels, ignore_index=True)
+
+
+def read_simplified(path: str, level: int) -> geopandas.GeoSeries:
+    """
+    Read the simplified geometries of patches for a zoom level
+
+    The geometries are simplified from the catalogue if preprocessing did not store
+    them next to it.
+
+    Parameters
+    ----------
+    path : str
+        Path to the GeoJSON file
+    level : int
+        Zoom level of the map
+
+    Returns
+    -------
+    geopandas.GeoSeries
+        Simplified geometries, indexed like the patches of the catalogue
+    """
+
+    import geopandas
+    import shapely
+
+    simplified_path = os.path.splitext(path)[0] + ".simplified.fgb"
+
+    if os.path.isfile(simplified_path):
+        simplified = geopandas.read_file(
+            simplified_path, engine="pyogrio", where=f"zoom = {level}"
+        )
+        return simplified.geometry
+
+    patches = read_catalogue(path)
+    geometries = shapely.simplify(
+        patches.geometry.values, simplify_tolerance(level), preserve_topology=True
+    )
+    return geopandas.GeoSeries(geometries, index=patches.index, crs=patches.crs)
+
+
+def encode_features(patches: geopandas.GeoDataFrame) -> pd.Series:
+    """
+    Encode each patch as a GeoJSON feature, so that feature collections of
+    selected patches are assembled without serializing their geometries again
+
+    Parameters
+    ----------
+    patches : geopandas.GeoDataFrame
+        Patches to encode
+
+    Returns
+    -------
+    pandas.Series
+        UTF-8 encoded features, indexed like the patches
+    """
+
+    fragments = [
+        json.dumps(feature).encode()
+        for feature in patches.iterfeatures(na="null", show_bbox=True)
+    ]
+    return pd.Series(fragments, index=patches.index, dtype=object)
+
+
+def replace_file(path: str, write: Callable[[str], None]) -> None:
+    """
+    Write a file next to its destination and move it in place, so that processes
+    reading or memory-mapping the previous file keep seeing a complete file
+
+    Parameters
+    ----------
+    path : str
+        Path of the file
+    write : callable
+        Function writing the file to the path it is given
+    """
+
+    directory, name = os.path.split(path)
+    # Hidden and with the same extension, which selects the format of some drivers
+    tmp_path = os.path.join(
+        directory, f".{name}.{os.getpid()}.tmp{os.path.splitext(name)[1]}"
+    )
+    try:
+        write(tmp_path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def write_catalogue(
+    patches: geopandas.GeoDataFrame,
+    stem: str,
+    stage: Callable[[str], AbstractContextManager[Any]] = nullcontext,
+) -> None:
+    """
+    Save patches as GeoJSON file and as binary FlatGeobuf file, along with their
+    simplified geometries for all zoom levels and a columnar file shared by the
+    workers of the web application
+
+    Literature references, which are dictionaries, are stored as JSON strings in
+    the FlatGeobuf file. Existing files are replaced atomically, so catalogues can
+    be rebuilt while the web application is running.
+
+    Parameters
+    ----------
+    patches : geopandas.GeoDataFrame
+        Patches to save
+    stem : str
+        Path of the output files without extension
+    stage : callable, default: nullcontext
+        Context manager called with the name of each step, such as
+        `exseas_explorer.preproc.preproc.stage` to profile the steps separately
+    """
+
+    with stage("write_geojson"):
+        replace_file(
+            f"{stem}.geojson",
+            lambda path: patches.to_file(
+                path, driver="GeoJSON", index=False, engine="fiona"
+            ),
+        )
+
+    binary = patches.copy()
+    for column in LITERATURE_COLUMNS:
+        if column in binary:
+            binary[column] = [
+                json.dumps(value) if isinstance(value, dict) else None
+                for value in binary[column]
+            ]
+
+    # Without spatial index, the order of features is preserved
+    with stage("write_fgb"):
+        replace_file(
+            f"{stem}.fgb",
+            lambda path: binary.to_file(
+                path,
+                driver="FlatGeobuf",
+                index=False,
+                engine="fiona",
+                SPATIAL_INDEX="NO",
+            ),
+        )
+
+    with stage("simplify"):
+        simplified = simplify_catalogue(patches)
+
+    with stage("write_simplified"):
+        replace_file(
+            f"{stem}.simplified.fgb",
+            lambda path: simplified.to_file(
+                path,
+                driver="FlatGeobuf",
+                index=False,
+                engine="fiona",
+                SPATIAL_INDEX="NO",
+            ),
+        )
+
+    with stage("write_columns"):
+        write_columns(patches, f"{stem}.columns.bin")
+
+
+def _align(position: int) -> int:
+    return -(-position // COLUMN_ALIGNMENT) * COLUMN_ALIGNMENT
+
+
+def write_columns(patches: geopandas.GeoDataFrame, path: str) -> None:
+    """
+    Save the numeric attributes of patches, their geometries as WKB and their
+    literature references as JSON in a columnar file
+
+    The file starts with the length of a JSON header describing the columns,
+    followed by the header and the aligned columns, so that they can be
+    memory-mapped without copying them.
+
+    The file is replaced atomically, processes memory-mapping the previous file
+    keep reading it.
+
+    Parameters
+    ----------
+    patches : geopandas.GeoDataFrame
+        Patches to save
+    path : str
+        Path of the columnar file
+    """
+
+    import shapely
+
+    arrays: list[tuple[int, np.ndarray]] = []
+    position = 0
+
+    def add(array: np.ndarray) -> int:
+        nonlocal position
+        offset = _align(position)
+        arrays.append((offset, array))
+        position = offset + array.nbytes
+        return offset
+
+    columns = []
+    for name in patches.columns:
+        if name == patches.geometry.name or name in LITERATURE_COLUMNS:
+            continue
+        values = np.ascontiguousarray(patches[name].to_numpy())
+        if values.dtype.kind in "biuf":
+            columns.append(
+                {"name": name, "dtype": values.dtype.str, "offset": add(values)}
+            )
+
+    literature_columns = [column for column in LITERATURE_COLUMNS if column in patches]
+    literature = [
+        (
+            json.dumps({column: row[column] for column in literature_columns}).encode()
+            if any(isinstance(row[column], dict) for column in literature_columns)
+            else b""
+        )
+        for _, row in patches[literature_columns].iterrows()
+    ]
+
+    # Variable length values are stored back to back, delimited by their offsets
+    blobs = []
+    for name, items in [
+        ("geometry", list(shapely.to_wkb(patches.geometry.values))),
+        ("literature", literature),
+    ]:
+        offsets = np.zeros(len(items) + 1, dtype="<i8")
+        offsets[1:] = np.cumsum([len(item) for item in items])
+        data = np.frombuffer(b"".join(items), dtype=np.uint8)
+        blobs.append({"name": name, "offsets": add(offsets), "data": add(data)})
+
+    header = json.dumps(
+        {
+            "rows": len(patches),
+            "crs": patches.crs.to_string() if patches.crs else None,
+            "columns": columns,
+            "blobs": blobs,
+            "literature_columns": literature_columns,
+        }
+    ).encode()
+    start = _align(8 + len(header))
+
+    def write(tmp_path: str) -> None:
+        with open(tmp_path, "wb") as out_file:
+            out_file.write(struct.pack("<Q", len(header)) + header)
+            for offset, array in arrays:
+                out_file.seek(start + offset)
+                out_file.write(array.tobytes())
+
+    replace_file(path, write)
+
+
+class ColumnStore:
+    """
+    Memory-mapped columnar file of a catalogue, as written by `write_columns`
+
+    The file is mapped read-only, so all processes reading it share the same
+    pages. Attributes are views of the mapped file, geometries and literature
+    references are only decoded for the patches requested.
+
+    Parameters
+    ----------
+    path : str
+        Path of the columnar file
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        buffer = np.memmap(path, dtype=np.uint8, mode="r")
+
+        size = int(buffer[:8].view("<u8")[0])
+        header = json.loads(buffer[8 : 8 + size].tobytes())
+        start = _align(8 + size)
+
+        def view(offset: int, dtype: np.dtype, count: int) -> np.ndarray:
+            begin = start + offset
+            array = buffer[begin : begin + count * dtype.itemsize]
+            return array.view(dtype=dtype, type=np.ndarray)
+
+        self.rows = header["rows"]
+        self.crs = header["crs"]
+        self.literature_columns = header["literature_columns"]
+        self.columns = {
+            column["name"]: view(column["offset"], np.dtype(column["dtype"]), self.rows)
+            for column in header["columns"]
+        }
+
+        self._blobs = {}
+        for blob in header["blobs"]:
+            offsets = view(blob["offsets"], np.dtype("<i8"), self.rows + 1)
+            data = view(blob["data"], np.dtype(np.uint8), int(offsets[-1]))
+            self._blobs[blob["name"]] = (offsets, data)
+
+        self._attributes: pd.DataFrame | None = None
+
+    def attributes(self) -> pd.DataFrame:
+        """
+        Numeric attributes of all patches, without copying them
+
+        Returns
+        -------
+        pandas.DataFrame
+            Attributes, indexed by the position of the patches
+        """
+
+        if self._attributes is None:
+            self._attributes = pd.DataFrame(self.columns, copy=False)
+        return self._attributes
+
+    def _blob(self, name: str, index: pd.Index) -> list[bytes]:
+        offsets, data = self._blobs[name]
+        return [data[offsets[i] : offsets[i + 1]].tobytes() for i in index]
+
+    def geometries(self, index: pd.Index) -> np.ndarray:
+        """
+        Decode the geometries of patches
+
+        Parameters
+        ----------
+        index : pandas.Index
+            Positions of the patches
+
+        Returns
+        -------
+        numpy.ndarray
+            Geometries
+        """
+
+        import shapely
+
+        return shapely.from_wkb(self._blob("geometry", index))
+
+    def literature(self, index: pd.Index) -> pd.DataFrame:
+        """
+        Decode the literature references of patches
+
+        Parameters
+        ----------
+        index : pandas.Index
+            Positions of the patches
+
+        Returns
+        -------
+        pandas.DataFrame
+            Literature references, None for patches without references
+        """
+
+        rows = [
+            json.loads(item) if item else {} for item in self._blob("literature", index)
+        ]
+        return pd.DataFrame(
+            {
+                column: pd.Series(
+                    [row.get(column) for row in rows], index=index, dtype=object
+                )
+                for column in self.literature_columns
+            },
+            index=index,
+        )
+
+
+def read_catalogue(path: str) -> geopandas.GeoDataFrame:
+    """
+    Read patches from a GeoJSON file, or from the FlatGeobuf file of the same
+    name if it exists
+
+    The FlatGeobuf file is read an order of magnitude faster than the GeoJSON
+    file. Its attributes can also be read on their own, without decoding the
+    geometries, with `geopandas.read_file(..., ignore_geometry=True)`.
+
+    Parameters
+    ----------
+    path : str
+        Path to the GeoJSON file
+
+    Returns
+    -------
+    geopandas.GeoDataFrame
+        Patches
+    """
+
+    import geopandas
+
+    binary_path = os.path.splitext(path)[0] + ".fgb"
+
+    if not os.path.isfile(binary_path):
+        with open(path) as in_file:
+            return geopandas.read_file(in_file, engine="fiona")
+
+    df = geopandas.read_file(binary_path, engine="pyogrio")
+
+    # Literature references are stored as JSON strings
+    for column in LITERATURE_COLUMNS:
+        if column in df:
+            values = [
+                json.loads(value) if isinstance(value, str) else None
+                for value in df[column]
+            ]
+            df[column] = pd.Series(values, index=df.index, dtype=object)
+
+    return df
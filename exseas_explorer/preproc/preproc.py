@@ -2,26 +2,209 @@
 Sub-module containing pre-processing functionality
 """
 
+import glob
+import hashlib
+import json
 import logging
 import os
 import sys
+import threading
+import time
+from collections.abc import Callable, Collection, Iterator
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import ExitStack, contextmanager, nullcontext
+from contextvars import ContextVar
+from itertools import repeat
+from typing import Any
 
 import click
 import numpy as np
 import pandas as pd
+import shapely
 import xarray as xr
-from geopandas import GeoDataFrame
+from geopandas import GeoDataFrame, read_file
 from pandas.errors import EmptyDataError
 from pyproj import CRS
 from rasterio import features
 from rasterio.transform import Affine
 from shapely.geometry import shape
 
+from exseas_explorer.catalogue import replace_file, write_catalogue
+
 level = logging.INFO
 fmt = "[%(levelname)s] %(asctime)s - %(message)s"
 logging.basicConfig(stream=sys.stdout, level=level, format=fmt)
 logger = logging.getLogger("__NAME__")
 
+# Increment whenever a change of the pipeline alters its output, to invalidate
+# the manifests of previous runs
+MANIFEST_VERSION = 2
+
+# Grids larger than this number of grid points in either direction are
+# polygonized in tiles
+TILE_SIZE = 720
+
+# Interval in seconds at which the memory of a profiled run is sampled
+SAMPLE_INTERVAL = 0.01
+
+
+def resident_memory() -> int:
+    """
+    Resident set size of the process in bytes, including memory allocated by
+    native libraries such as GEOS and GDAL
+
+    Where the current size cannot be read, the maximum size so far is returned.
+    """
+
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        import resource
+
+        # In kilobytes on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class Profile:
+    """
+    Wall time, CPU time and peak memory of the stages of a pre-processing run,
+    together with counts of processed objects
+
+    Peak memory is the largest resident set size of the process during a stage,
+    sampled by a background thread so that measuring it does not slow down the
+    run. Stages run in worker processes are not recorded.
+    """
+
+    def __init__(self, interval: float = SAMPLE_INTERVAL) -> None:
+        self.stages: dict[str, dict[str, float]] = {}
+        self.counts: dict[str, int] = {}
+        self._wall_time = time.perf_counter()
+        self._cpu_time = time.process_time()
+
+        # Peak memory of the stages in progress, updated by the sampler
+        self._peaks: list[list[int]] = []
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._sampler = threading.Thread(
+            target=self._sample, args=(interval,), name="profile", daemon=True
+        )
+        self._sampler.start()
+
+    def _sample(self, interval: float) -> None:
+        while not self._stop.wait(interval):
+            self._update_peaks()
+
+    def _update_peaks(self) -> None:
+        memory = resident_memory()
+        with self._lock:
+            for peak in self._peaks:
+                peak[0] = max(peak[0], memory)
+
+    def close(self) -> None:
+        """Stop sampling memory"""
+
+        self._stop.set()
+        self._sampler.join()
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        """Record a stage, accumulating repeated calls of the same stage"""
+
+        peak = [resident_memory()]
+        with self._lock:
+            self._peaks.append(peak)
+        wall_time = time.perf_counter()
+        cpu_time = time.process_time()
+        try:
+            yield
+        finally:
+            wall_time = time.perf_counter() - wall_time
+            cpu_time = time.process_time() - cpu_time
+            self._update_peaks()
+            with self._lock:
+                self._peaks.remove(peak)
+
+            record = self.stages.setdefault(
+                name, {"calls": 0, "wall_time": 0.0, "cpu_time": 0.0, "peak_memory": 0}
+            )
+            record["calls"] += 1
+            record["wall_time"] += wall_time
+            record["cpu_time"] += cpu_time
+            record["peak_memory"] = max(record["peak_memory"], peak[0])
+
+    def count(self, name: str, value: int) -> None:
+        """Add to the count of objects `name`"""
+
+        self.counts[name] = self.counts.get(name, 0) + int(value)
+
+    def report(self) -> dict[str, Any]:
+        """Summary of the run so far"""
+
+        report: dict[str, Any] = {
+            "wall_time": time.perf_counter() - self._wall_time,
+            "cpu_time": time.process_time() - self._cpu_time,
+            "stages": self.stages,
+            "counts": self.counts,
+        }
+
+        try:
+            import resource
+
+            # Maximum resident set size of the process, in kilobytes on Linux
+            report["max_rss"] = (
+                resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+            )
+        except ImportError:
+            pass
+
+        return report
+
+
+# Profile of the current pre-processing run, if profiling is enabled
+_PROFILE: ContextVar[Profile | None] = ContextVar("profile", default=None)
+
+
+@contextmanager
+def profiling(path: str) -> Iterator[Profile]:
+    """
+    Profile all stages run inside the context and write a JSON report
+
+    Parameters
+    ----------
+    path : str
+        Path of the JSON report
+    """
+
+    profile = Profile()
+    token = _PROFILE.set(profile)
+    try:
+        yield profile
+    finally:
+        profile.close()
+        _PROFILE.reset(token)
+        with open(path, "w") as f:
+            json.dump(profile.report(), f, indent=2)
+
+
+@contextmanager
+def stage(name: str) -> Iterator[Profile | None]:
+    """
+    Record a stage in the profile of the current run, if profiling is enabled
+
+    Parameters
+    ----------
+    name : str
+        Name of the stage
+    """
+
+    profile = _PROFILE.get()
+    if profile is None:
+        yield None
+    else:
+        with profile.stage(name):
+            yield profile
+
 
 def affine_transform(array: xr.DataArray) -> Affine:
     """Returns the transform operator relating index coordinates to
@@ -33,63 +216,441 @@ def affine_transform(array: xr.DataArray) -> Affine:
         transform operator for georeferencing guidance data
     """
 
-    mean_grid_spacing: float = (
-        np.gradient(array.lon).mean() + np.gradient(array.lat).mean()
-    ) / 2
+    lon_spacing: float = np.gradient(array.lon).mean()
+    lat_spacing: float = np.gradient(array.lat).mean()
 
     return Affine.translation(
-        array.lon.values[0] - 0.5 * mean_grid_spacing,
-        array.lat.values[0] - 0.5 * mean_grid_spacing,
-    ) * Affine.scale(mean_grid_spacing, mean_grid_spacing)
+        array.lon.values[0] - 0.5 * lon_spacing,
+        array.lat.values[0] - 0.5 * lat_spacing,
+    ) * Affine.scale(lon_spacing, lat_spacing)
 
 
-def extract_contours(array: xr.DataArray) -> GeoDataFrame:
+def global_period(ncols: int, spacing: float) -> tuple[int, bool]:
     """
-    Extract contours
+    Number of grid points of one revolution of a global longitude axis
+
+    Global grids either repeat their first longitude as last one (e.g. -180 to
+    180 degrees) or end one grid spacing before it (e.g. 0 to 359.75 degrees).
 
     Parameters
     ----------
-    array : xr.DataArray
-        Input data array (do not pass a dataset!)
+    ncols : int
+        Number of longitudes of the grid
+    spacing : float
+        Longitude spacing in degrees
 
     Returns
     -------
-    GeoDataFrame
-        Polygons of input array in a geodataframe
+    tuple
+        Number of grid points per revolution and whether the last longitude
+        repeats the first one
+
+    Raises
+    ------
+    ValueError
+        If the grid does not span exactly one revolution in either layout
     """
 
-    # List holding all and land only contours
-    polygons = []
+    period = 360 / abs(spacing)
+    if abs(period - round(period)) < 1e-6 * period:
+        if ncols == round(period):
+            return ncols, False
+        if ncols == round(period) + 1:
+            return ncols - 1, True
 
-    # Compute affine transformer (relating x-y to coordinates)
-    affine = affine_transform(array)
+    raise ValueError(
+        f"{ncols} longitudes spaced by {spacing} degrees do not span a global grid"
+    )
 
-    # Iterate over years
-    for year in array.year:
 
-        # Contour object generator
-        contours = features.shapes(
-            array.sel(year=year).values, transform=affine, connectivity=4
-        )
+def smooth_geometries(geometries: np.ndarray) -> np.ndarray:
+    """
+    Smooth the staircase outline of polygonized raster objects by buffering
+    them outwards and back inwards
+
+    Parameters
+    ----------
+    geometries : np.ndarray
+        Array of input geometries
+
+    Returns
+    -------
+    np.ndarray
+        Array of smoothed geometries
+    """
+
+    geometries = shapely.buffer(geometries, 0.5, join_style="bevel")
+
+    return shapely.buffer(geometries, -0.5, join_style="mitre")
+
+
+def shift_geometries(geometries: np.ndarray, xoff: float) -> np.ndarray:
+    """
+    Translate an array of geometries in the x-direction
+
+    Parameters
+    ----------
+    geometries : np.ndarray
+        Array of input geometries
+    xoff : float
+        Offset in the x-direction
+
+    Returns
+    -------
+    np.ndarray
+        Array of translated geometries
+    """
+
+    return shapely.transform(geometries, lambda coords: coords + (xoff, 0.0))
+
+
+def stitch_geometries(
+    labels: np.ndarray, geometries: np.ndarray
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Merge touching pieces of objects which were polygonized separately
+
+    Parameters
+    ----------
+    labels : np.ndarray
+        Array of labels
+    geometries : np.ndarray
+        Array of geometries
+
+    Returns
+    -------
+    tuple
+        Array of labels and array of geometries with one polygon per connected
+        part of each object
+    """
+
+    stitched_labels = [np.empty(0, dtype=labels.dtype)]
+    stitched_geometries = [np.empty(0, dtype=object)]
+    for val in np.unique(labels):
+        parts = shapely.get_parts(shapely.union_all(geometries[labels == val]))
+        stitched_labels.append(np.full(len(parts), val, dtype=labels.dtype))
+        stitched_geometries.append(parts)
+
+    return np.concatenate(stitched_labels), np.concatenate(stitched_geometries)
+
+
+def polygonize(
+    values: np.ndarray, affine: Affine, tile_size: int = TILE_SIZE
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Convert all objects of a label array to polygons
+
+    Arrays larger than `tile_size` in either direction are polygonized in tiles
+    of `tile_size` x `tile_size` grid points, and objects touching the edge of a
+    tile are merged with their neighbouring pieces afterwards.
+
+    Parameters
+    ----------
+    values : np.ndarray
+        Two-dimensional label array
+    affine : rasterio.transform.Affine
+        Transform operator relating index coordinates to geographical coordinates
+    tile_size : int, default: TILE_SIZE
+        Number of grid points per tile and direction, 0 to disable tiling
+
+    Returns
+    -------
+    tuple
+        Array of labels and array of geometries
+    """
+
+    nrows, ncols = values.shape
+
+    if tile_size <= 0 or (nrows <= tile_size and ncols <= tile_size):
+        values_list = []
+        geometries_list = []
 
         # Iterate over object generator
-        for geom, val in contours:
+        for geom, val in features.shapes(values, transform=affine, connectivity=4):
 
             # Avoid passing entire domain as final polygon
             if val != 0:
+                values_list.append(val)
+                geometries_list.append(shape(geom))
+
+        return (
+            np.array(values_list, dtype=np.int64),
+            np.array(geometries_list, dtype=object),
+        )
+
+    # Pieces of objects inside a single tile and touching edges shared with others
+    inner: list[tuple[np.ndarray, np.ndarray]] = []
+    seam: list[tuple[np.ndarray, np.ndarray]] = []
+
+    # Polygonize tiles in index coordinates, which are exact at the tile edges
+    for row in range(0, nrows, tile_size):
+        for col in range(0, ncols, tile_size):
+            tile = np.ascontiguousarray(
+                values[row : row + tile_size, col : col + tile_size]
+            )
+            labels, geometries = polygonize(
+                tile, Affine.translation(col, row), tile_size=0
+            )
+
+            minx, miny, maxx, maxy = shapely.bounds(geometries).T
+            touching = (
+                ((col > 0) & (minx <= col))
+                | ((col + tile.shape[1] < ncols) & (maxx >= col + tile.shape[1]))
+                | ((row > 0) & (miny <= row))
+                | ((row + tile.shape[0] < nrows) & (maxy >= row + tile.shape[0]))
+            )
+
+            inner.append((labels[~touching], geometries[~touching]))
+            seam.append((labels[touching], geometries[touching]))
+
+    stitched = stitch_geometries(
+        np.concatenate([labels for labels, _ in seam]),
+        np.concatenate([geometries for _, geometries in seam]),
+    )
+    labels = np.concatenate([labels for labels, _ in inner + [stitched]])
+    geometries = np.concatenate([geometries for _, geometries in inner + [stitched]])
+
+    # Transform index to geographical coordinates
+    geometries = shapely.transform(
+        geometries, lambda coords: coords * (affine.a, affine.e) + (affine.c, affine.f)
+    )
+
+    return labels, geometries
+
+
+def extract_year(
+    values: np.ndarray, affine: Affine, tile_size: int = TILE_SIZE
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Extract and smooth contours of a single year
+
+    Parameters
+    ----------
+    values : np.ndarray
+        Two-dimensional label array of a single year
+    affine : rasterio.transform.Affine
+        Transform operator relating index coordinates to geographical coordinates
+    tile_size : int, default: TILE_SIZE
+        Number of grid points per tile and direction, 0 to disable tiling
+
+    Returns
+    -------
+    tuple
+        Array of labels and array of smoothed geometries
+    """
+
+    with stage("polygonize"):
+        labels, geometries = polygonize(values, affine, tile_size)
+
+    with stage("smooth"):
+        geometries = smooth_geometries(geometries)
+
+    return labels, geometries
+
+
+def extract_year_wrapped(
+    values: np.ndarray, affine: Affine, tile_size: int = TILE_SIZE
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Extract and smooth contours of a single year of a global, periodic grid
+
+    Produces the same polygons as `extract_year` applied to the output of
+    `extend_domain`, without tripling the grid: the grid is polygonized once,
+    objects touching the date-line are stitched with their copies shifted by
+    +-360 degrees, and all other objects are translated to the three copies.
+
+    Parameters
+    ----------
+    values : np.ndarray
+        Two-dimensional label array of a single year of a global grid, whose
+        last longitude may repeat the first one (see `global_period`)
+    affine : rasterio.transform.Affine
+        Transform operator relating index coordinates to geographical coordinates
+    tile_size : int, default: TILE_SIZE
+        Number of grid points per tile and direction, 0 to disable tiling
+
+    Returns
+    -------
+    tuple
+        Array of labels and array of smoothed geometries
+    """
+
+    # Number of grid points and extent in degrees of one revolution
+    period, closed = global_period(values.shape[1], affine.a)
+    width = period * affine.a
+    west = affine.c
+    east = west + width
+    offsets = (-width, 0.0, width)
+
+    with stage("polygonize"):
+        # Polygonize a single copy of the globe
+        labels, geometries = polygonize(
+            np.ascontiguousarray(values[:, :period]), affine, tile_size
+        )
+
+        # Objects crossing the date-line need to be stitched first
+        minx, _, maxx, _ = shapely.bounds(geometries).T
+        crossing = (minx <= west) | (maxx >= east)
+
+        # A repeated last longitude closes the eastern copy
+        strip_labels = np.empty(0, dtype=np.int64)
+        strip_geometries = np.empty(0, dtype=object)
+        if closed:
+            strip_labels, strip_geometries = polygonize(
+                np.ascontiguousarray(values[:, period:]),
+                affine * Affine.translation(2 * period, 0),
+                tile_size,
+            )
+
+        # Merge copies touching each other across the date-line
+        stitched_labels, stitched_geometries = stitch_geometries(
+            np.concatenate([np.tile(labels[crossing], 3), strip_labels]),
+            np.concatenate(
+                [shift_geometries(geometries[crossing], offset) for offset in offsets]
+                + [strip_geometries]
+            ),
+        )
+
+        labels = np.concatenate([np.tile(labels[~crossing], 3), stitched_labels])
+        geometries = np.concatenate(
+            [shift_geometries(geometries[~crossing], offset) for offset in offsets]
+            + [stitched_geometries]
+        )
+
+    with stage("smooth"):
+        geometries = smooth_geometries(geometries)
+
+    return labels, geometries
+
+
+def label_dtype(max_label: int) -> np.dtype:
+    """
+    Smallest integer data-type supported by `features.shapes` that holds all labels
+
+    Parameters
+    ----------
+    max_label : int
+        Largest label of the array
+
+    Returns
+    -------
+    np.dtype
+        One of uint8, uint16 or int32
+    """
+
+    for dtype in (np.uint8, np.uint16, np.int32):
+        if max_label <= np.iinfo(dtype).max:
+            return np.dtype(dtype)
+
+    raise ValueError(f"Label {max_label} exceeds the range of int32")
+
+
+def read_labels(
+    array: xr.DataArray, exclude: Collection[int] | None = None
+) -> xr.DataArray:
+    """
+    Load (a block of) a label array into memory and prepare it for polygonization
+
+    Parameters
+    ----------
+    array : xr.DataArray
+        Input data array, possibly lazily loaded from a file
+    exclude : collection of int, optional
+        Labels which are set to zero and hence not polygonized
+
+    Returns
+    -------
+    xr.DataArray
+        Label array in memory with the smallest integer data-type holding all labels
+    """
+
+    array = array.load()
+
+    # Labels are stored as floating point numbers in the NetCDF files
+    if array.dtype.kind == "f":
+        array = array.fillna(0)
+
+    # Change data-type to work with shapes features
+    array = array.astype(label_dtype(int(array.max())), copy=False)
+
+    if exclude is not None and len(exclude) > 0:
+        array = array.where(~array.isin(exclude), 0)
+
+    return array
+
+
+def extract_contours(
+    array: xr.DataArray,
+    workers: int = 1,
+    wrap: bool = False,
+    block_years: int = 1,
+    exclude: Collection[int] | None = None,
+    tile_size: int = TILE_SIZE,
+) -> GeoDataFrame:
+    """
+    Extract contours
+
+    The array is read in blocks of years, so that a lazily loaded array is never
+    held in memory as a whole.
+
+    Parameters
+    ----------
+    array : xr.DataArray
+        Input data array (do not pass a dataset!)
+    workers : int, default: 1
+        Number of worker processes used to extract the years concurrently. The
+        output order is the same as for serial extraction.
+    wrap : bool, default: False
+        Treat `array` as a global grid (see `global_period`) and extract
+        date-line continuous polygons, equivalent to passing the output of
+        `extend_domain`
+    block_years : int, default: 1
+        Number of years read into memory at once, at least `workers`
+    exclude : collection of int, optional
+        Labels which are not polygonized
+    tile_size : int, default: TILE_SIZE
+        Number of grid points per tile and direction, 0 to disable tiling
+
+    Returns
+    -------
+    GeoDataFrame
+        Polygons of input array in a geodataframe
+    """
 
-                # Extract geometry and save to large list
-                geometry = shape(geom)
+    # Compute affine transformer (relating x-y to coordinates)
+    affine = affine_transform(array)
+    if wrap:
+        # Fail before reading any year
+        global_period(array.sizes["lon"], affine.a)
+
+    extract = extract_year_wrapped if wrap else extract_year
+    block = max(block_years, workers)
+    results: list[tuple[np.ndarray, np.ndarray]] = []
 
-                # Buffer polygon to make it smooth
-                geometry = geometry.buffer(0.5, join_style=3).buffer(-0.5, join_style=2)
+    with ExitStack() as stack:
+        mapper: Callable = map
+        if workers > 1:
+            # Executor.map returns results in submission order
+            executor = stack.enter_context(ProcessPoolExecutor(max_workers=workers))
+            mapper = executor.map
 
-                # Save polygon to list of polygons
-                polygons.append([int(val), geometry])
+        # Iterate over blocks of years
+        for start in range(0, array.sizes["year"], block):
+            with stage("read_labels"):
+                years = read_labels(
+                    array.isel(year=slice(start, start + block)), exclude
+                )
+            results.extend(
+                mapper(extract, years.values, repeat(affine), repeat(tile_size))
+            )
 
-    # Convert list to GeoDataFrame
+    # Build GeoDataFrame straight from the label and geometry arrays
+    labels = [np.empty(0, dtype=np.int64)] + [labels for labels, _ in results]
+    geometries = [np.empty(0, dtype=object)] + [geoms for _, geoms in results]
     gdf = GeoDataFrame(
-        data=polygons, columns=["label", "geometry"], crs=CRS.from_epsg(4326)
+        data={"label": np.concatenate(labels)},
+        geometry=np.concatenate(geometries),
+        crs=CRS.from_epsg(4326),
     )
 
     return gdf
@@ -103,78 +664,236 @@ def extend_domain(da: xr.DataArray) -> xr.DataArray:
     Parameters
     ----------
     ds : xr.DataArray
-        Input data array
+        Input data array of a global grid, whose last longitude may repeat the
+        first one (see `global_period`)
 
     Returns
     -------
     out : xr.DataArray
         Output data array with extended domain
+
+    Raises
+    ------
+    ValueError
+        If the longitudes are not evenly spaced or do not span a global grid
     """
 
-    out = xr.concat([da[:, :, :-1], da[:, :, :-1], da], dim="lon")
-    out.coords["lon"] = np.linspace(-540, 540, 2161)
+    lon = da.lon.values
+    spacing = np.diff(lon)
+    if not np.allclose(spacing, spacing[0]):
+        raise ValueError("Longitudes of a global grid must be evenly spaced")
+    period, _ = global_period(len(lon), spacing[0])
+
+    # A repeated last longitude is only kept at the eastern end
+    out = xr.concat([da[:, :, :period], da[:, :, :period], da], dim="lon")
+    out.coords["lon"] = np.concatenate([lon[:period] - 360, lon[:period], lon + 360])
 
     return out
 
 
-@click.command()
-@click.option(
-    "-w", "--work_dir", default="/net/thermo/atmosdyn/maxibo/intexseas/webpage/"
-)
-@click.option("-p", "--patch_file", default="patches_40y_era5_RTOT_djf_ProbDry.nc")
-def update_patches(
-    work_dir: str = "/ytpool/data/ETH/INTEXseas/",
-    patch_file: str = "patches_T2M_jja_ProbHot.nc",
-) -> GeoDataFrame:
-    """Read extreme season patches from NetCDF file, convert to polygons, and
-    save as GeoJSON files
+def sidecar_file(patch_file: str, prefix: str) -> str:
+    """
+    Name of a text file accompanying a patch file, e.g. the list of patches
+    `list_T2M_jja_Hot.txt` for `patches_T2M_jja_ProbHot.nc`
 
     Parameters
     ----------
-    work_dir : str
-        Working directory
     patch_file : str
-        Input file to process
+        Name of the patch file
+    prefix : str
+        Prefix of the sidecar file, either 'list' or 'lit'
 
-    Examples
-    --------
+    Returns
+    -------
+    str
+        Name of the sidecar file
+    """
 
-    >>> files=*.nc
-    >>> for file in $files; do python /home/roman/projects/exseas_explorer/exseas_explorer/preproc/preproc.py -w /ytpool/data/ETH/INTEXseas/ -p $file; done
+    return (
+        patch_file.replace("patches", prefix).replace(".nc", ".txt").replace("Prob", "")
+    )
+
+
+def file_signature(path: str, previous: dict[str, Any] | None = None) -> dict | None:
     """
+    Size, modification time and SHA-256 hash of a file
 
-    logger.info(f"Processing {work_dir}{patch_file}")
+    Parameters
+    ----------
+    path : str
+        Path to the file
+    previous : dict, optional
+        Previously recorded signature of the file, whose hash is reused if size
+        and modification time did not change
+
+    Returns
+    -------
+    dict or None
+        Signature of the file, None if it does not exist
+    """
 
-    # Read NetCDF file
-    path = os.path.join(work_dir, patch_file)
-    in_file = xr.open_dataset(path)  # type: ignore[no-untyped-call]
+    if not os.path.isfile(path):
+        return None
 
-    # Re-name key xarray and change data-type to work with shapes features
-    in_file = in_file.rename({"time": "year"}).astype(np.float32)
+    stat = os.stat(path)
+    if (
+        previous is not None
+        and previous["size"] == stat.st_size
+        and previous["mtime"] == stat.st_mtime_ns
+    ):
+        return previous
+
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha256.update(chunk)
+
+    return {
+        "size": stat.st_size,
+        "mtime": stat.st_mtime_ns,
+        "sha256": sha256.hexdigest(),
+    }
+
+
+def read_manifest(path: str) -> dict[str, Any]:
+    """
+    Read the manifest of a previous pre-processing run
+
+    Parameters
+    ----------
+    path : str
+        Path to the manifest
+
+    Returns
+    -------
+    dict
+        Content of the manifest, empty if it does not exist or is unreadable
+    """
+
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def build_contours(
+    patch_path: str,
+    list_path: str,
+    year_workers: int = 1,
+    wrap: bool = True,
+    min_area: float = 100000,
+    block_years: int = 1,
+    tile_size: int = TILE_SIZE,
+) -> GeoDataFrame:
+    """
+    Convert patches to polygons and combine them with the list of patches
+
+    Parameters
+    ----------
+    patch_path : str
+        Path to the NetCDF file with patches
+    list_path : str
+        Path to the list of patches
+    year_workers : int, default: 1
+        Number of worker processes used to extract contours of different years
+    wrap : bool, default: True
+        Polygonize the grid once and stitch objects across the date-line instead
+        of tripling the domain with `extend_domain`
+    min_area : float, default: 100000
+        Patches with an area (km^2) smaller than this are discarded
+    block_years : int, default: 1
+        Number of years read into memory at once. Only the label variable is
+        read, one block at a time, unless `wrap` is False.
+    tile_size : int, default: TILE_SIZE
+        Number of grid points per tile and direction, 0 to disable tiling
+
+    Returns
+    -------
+    GeoDataFrame
+        One (multi-)polygon per patch with its statistics
+    """
 
     # Read dataframe with additional data on patches
-    list_file = (
-        patch_file.replace("patches", "list").replace(".nc", ".txt").replace("Prob", "")
-    )
-    patch_data = pd.read_csv(os.path.join(work_dir, list_file), na_values="-999.99")
-    patch_data = patch_data.astype({"label": "int32", "year": "int32"})
+    with stage("read_list"):
+        patch_data = pd.read_csv(list_path, na_values="-999.99")
+        patch_data = patch_data.astype({"label": "int32", "year": "int32"})
+
+    # Remove patches smaller than min_area before converting them to polygons
+    small = patch_data["label"][patch_data["area"] < min_area].to_numpy()
+
+    # Lazily open the label variable of the NetCDF file and re-name key
+    with xr.open_dataset(patch_path) as in_file:  # type: ignore[no-untyped-call]
+        label = in_file["label"].rename({"time": "year"})
+
+        # Extract date-line continuous contours
+        if wrap:
+            patch = extract_contours(
+                label,
+                workers=year_workers,
+                wrap=True,
+                block_years=block_years,
+                exclude=small,
+                tile_size=tile_size,
+            )
+        else:
+            with stage("read_labels"):
+                label = read_labels(label, exclude=small)
+            with stage("extend_domain"):
+                label = extend_domain(label)
+            patch = extract_contours(label, workers=year_workers, tile_size=tile_size)
+
+    with stage("merge"):
+        # Merge contour data with geodataframe
+        patch_out = patch.merge(patch_data, on="label")
 
-    # Expand domain and extract contours
-    label = extend_domain(in_file.label)
-    patch = extract_contours(label)
+        # Drop unused columns
+        patch_out = patch_out.drop(
+            columns=[
+                "ngp",
+                "land_ngp",
+                "median_prob",
+                "mean_prob",
+                "land_median_prob",
+                "land_mean_prob",
+                "median_ano",
+                "land_median_ano",
+            ]
+        )
+
+    # Combine polygons with same label
+    with stage("dissolve") as profile:
+        polygons = len(patch_out)
+        patch_out = patch_out.dissolve(by="label").reset_index(level=0)
 
-    # Merge contour data with geodataframe
-    patch_out = patch.merge(patch_data, on="label")
+    if profile is not None:
+        profile.count("polygons_before_dissolve", polygons)
+        profile.count("polygons_after_dissolve", len(patch_out))
+
+    return patch_out
+
+
+def merge_literature(patches: GeoDataFrame, lit_path: str) -> GeoDataFrame:
+    """
+    Add literature references to patches
+
+    Parameters
+    ----------
+    patches : GeoDataFrame
+        Patches as returned by `build_contours`
+    lit_path : str
+        Path to the list of literature references
+
+    Returns
+    -------
+    GeoDataFrame
+        Patches with literature references
+    """
 
     try:
         # Read dataframe with literature information
-        lit_file = (
-            patch_file.replace("patches", "lit")
-            .replace(".nc", ".txt")
-            .replace("Prob", "")
-        )
         lit_data = pd.read_csv(
-            os.path.join(work_dir, lit_file),
+            lit_path,
             na_values="-999.99",
             skip_blank_lines=True,
             sep=";",
@@ -185,37 +904,395 @@ def update_patches(
         lit_data = lit_data.groupby("label").agg(dict)
 
         # Merge literature data with DF
-        patch_out = patch_out.merge(lit_data, on="label", how="left")
+        patches = patches.merge(lit_data, on="label", how="left")
 
     except EmptyDataError:
         logger.info("No literature available for this extreme season")
 
-    # Drop unused columns
-    patch_out = patch_out.drop(
-        columns=[
-            "ngp",
-            "land_ngp",
-            "median_prob",
-            "mean_prob",
-            "land_median_prob",
-            "land_mean_prob",
-            "median_ano",
-            "land_median_ano",
+    return patches
+
+
+def process_patches(
+    work_dir: str = "/ytpool/data/ETH/INTEXseas/",
+    patch_file: str = "patches_T2M_jja_ProbHot.nc",
+    year_workers: int = 1,
+    wrap: bool = True,
+    min_area: float = 100000,
+    block_years: int = 1,
+    tile_size: int = TILE_SIZE,
+    force: bool = False,
+    profile: bool = False,
+) -> GeoDataFrame | None:
+    """Read extreme season patches from NetCDF file, convert to polygons, and
+    save as GeoJSON and FlatGeobuf files
+
+    A manifest recording the signatures of all input files and the processing
+    parameters is written next to the GeoJSON file, together with a cache of the
+    polygons before literature references are added. Unchanged catalogues are
+    skipped and a change limited to the literature only repeats the merge step.
+
+    Parameters
+    ----------
+    work_dir : str
+        Working directory
+    patch_file : str
+        Input file to process
+    year_workers : int, default: 1
+        Number of worker processes used to extract contours of different years
+    wrap : bool, default: True
+        Polygonize the grid once and stitch objects across the date-line instead
+        of tripling the domain with `extend_domain`
+    min_area : float, default: 100000
+        Patches with an area (km^2) smaller than this are discarded
+    block_years : int, default: 1
+        Number of years read into memory at once
+    tile_size : int, default: TILE_SIZE
+        Number of grid points per tile and direction, 0 to disable tiling
+    force : bool, default: False
+        Process the catalogue even if no input changed
+    profile : bool, default: False
+        Write wall time, CPU time and peak memory of each stage and object
+        counts as JSON report next to the GeoJSON file
+
+    Returns
+    -------
+    GeoDataFrame or None
+        Processed patches as written to the GeoJSON file, None if the catalogue
+        was unchanged and skipped
+    """
+
+    logger.info(f"Processing {work_dir}{patch_file}")
+
+    stem = os.path.join(work_dir, os.path.splitext(patch_file)[0])
+    out_path = f"{stem}.geojson"
+    cache_path = f"{stem}.contours.fgb"
+    manifest_path = f"{stem}.manifest.json"
+    profile_path = f"{stem}.profile.json"
+
+    paths = {
+        "patches": os.path.join(work_dir, patch_file),
+        "list": os.path.join(work_dir, sidecar_file(patch_file, "list")),
+        "lit": os.path.join(work_dir, sidecar_file(patch_file, "lit")),
+    }
+    parameters = {"version": MANIFEST_VERSION, "wrap": wrap, "min_area": min_area}
+
+    # Compare input files and parameters with the previous run
+    previous = read_manifest(manifest_path)
+    previous_inputs = previous.get("inputs", {})
+    inputs = {
+        key: file_signature(path, previous_inputs.get(key))
+        for key, path in paths.items()
+    }
+
+    def unchanged(*keys: str) -> bool:
+        for key in keys:
+            current, recorded = inputs[key], previous_inputs.get(key)
+            if current is None or recorded is None:
+                return False
+            if current["sha256"] != recorded["sha256"]:
+                return False
+        return True
+
+    contours_unchanged = (
+        not force
+        and previous.get("parameters") == parameters
+        and unchanged("patches", "list")
+        and os.path.isfile(cache_path)
+    )
+
+    outputs_exist = all(
+        os.path.isfile(output)
+        for output in [
+            out_path,
+            f"{stem}.fgb",
+            f"{stem}.simplified.fgb",
+            f"{stem}.columns.bin",
         ]
     )
+    if contours_unchanged and unchanged("lit") and outputs_exist:
+        logger.info(f"Skipping {patch_file}, inputs unchanged")
+        return None
 
-    # Combine polygons with same label
-    patch_out = patch_out.dissolve(by="label").reset_index(level=0)
+    with profiling(profile_path) if profile else nullcontext():
+        if contours_unchanged:
+            logger.info("Contours unchanged, only merging literature")
+            with stage("read_cache"):
+                patch_out = read_file(cache_path, engine="pyogrio")
+        else:
+            patch_out = build_contours(
+                paths["patches"],
+                paths["list"],
+                year_workers=year_workers,
+                wrap=wrap,
+                min_area=min_area,
+                block_years=block_years,
+                tile_size=tile_size,
+            )
+            # Plain data rather than a pickle, the working directory may be shared
+            with stage("write_cache"):
+                replace_file(
+                    cache_path,
+                    lambda path: patch_out.to_file(
+                        path,
+                        driver="FlatGeobuf",
+                        index=False,
+                        engine="fiona",
+                        SPATIAL_INDEX="NO",
+                    ),
+                )
+
+        with stage("literature"):
+            patch_out = merge_literature(patch_out, paths["lit"])
+
+        # Save geometries to file, recording each output as its own stage
+        write_catalogue(patch_out, stem, stage=stage)
+
+        run_profile = _PROFILE.get()
+        if run_profile is not None:
+            vertices = shapely.get_num_coordinates(patch_out.geometry.values).sum()
+            run_profile.count("vertices_written", vertices)
+
+    # Record inputs last, so that an interrupted run is repeated
+    with open(manifest_path, "w") as f:
+        json.dump({"parameters": parameters, "inputs": inputs}, f, indent=2)
+
+    return patch_out
+
+
+@click.command()
+@click.option(
+    "-w", "--work_dir", default="/net/thermo/atmosdyn/maxibo/intexseas/webpage/"
+)
+@click.option("-p", "--patch_file", default="patches_40y_era5_RTOT_djf_ProbDry.nc")
+@click.option("-j", "--year_workers", default=1, type=int)
+@click.option("--wrap/--no-wrap", default=True)
+@click.option("-a", "--min_area", default=100000, type=float)
+@click.option("-b", "--block_years", default=1, type=int)
+@click.option("-t", "--tile_size", default=TILE_SIZE, type=int)
+@click.option("-f", "--force", is_flag=True, default=False)
+@click.option("--profile", is_flag=True, default=False)
+def update_patches(
+    work_dir: str = "/ytpool/data/ETH/INTEXseas/",
+    patch_file: str = "patches_T2M_jja_ProbHot.nc",
+    year_workers: int = 1,
+    wrap: bool = True,
+    min_area: float = 100000,
+    block_years: int = 1,
+    tile_size: int = TILE_SIZE,
+    force: bool = False,
+    profile: bool = False,
+) -> None:
+    """Read extreme season patches from NetCDF file, convert to polygons, and
+    save as GeoJSON files
 
-    # Remove geometries smaller than 100'000km^2
-    patch_out.drop(patch_out[patch_out["area"] < 100000].index, inplace=True)
+    Parameters
+    ----------
+    work_dir : str
+        Working directory
+    patch_file : str
+        Input file to process
+    year_workers : int, default: 1
+        Number of worker processes used to extract contours of different years
+    wrap : bool, default: True
+        Polygonize the grid once and stitch objects across the date-line instead
+        of tripling the domain with `extend_domain`
+    min_area : float, default: 100000
+        Patches with an area (km^2) smaller than this are discarded
+    block_years : int, default: 1
+        Number of years read into memory at once
+    tile_size : int, default: TILE_SIZE
+        Number of grid points per tile and direction, 0 to disable tiling
+    force : bool, default: False
+        Process the catalogue even if no input changed
+    profile : bool, default: False
+        Write a JSON report with timings, memory and object counts per stage
 
-    # Save geometries to file
-    file_end = patch_file.replace("nc", "geojson")
-    patch_out.to_file(
-        os.path.join(work_dir, file_end), driver="GeoJSON", index=False, engine="fiona"
+    Examples
+    --------
+
+    >>> python exseas_explorer/preproc/preproc.py -w /ytpool/data/ETH/INTEXseas/ -p patches_T2M_jja_ProbHot.nc
+    """
+
+    process_patches(
+        work_dir,
+        patch_file,
+        year_workers=year_workers,
+        wrap=wrap,
+        min_area=min_area,
+        block_years=block_years,
+        tile_size=tile_size,
+        force=force,
+        profile=profile,
     )
 
 
+def _process_worker(
+    work_dir: str, patch_file: str, options: dict[str, Any]
+) -> tuple[str, bool, str | None, float]:
+    """Process a single patch file inside a worker process
+
+    Parameters
+    ----------
+    work_dir : str
+        Working directory
+    patch_file : str
+        Input file to process
+    options : dict
+        Further keyword arguments passed to `process_patches`
+
+    Returns
+    -------
+    tuple
+        Name of the patch file, whether it was skipped as unchanged, error
+        message (None on success) and wall time in seconds
+    """
+
+    start = time.perf_counter()
+    skipped = False
+    try:
+        skipped = process_patches(work_dir, patch_file, **options) is None
+        error = None
+    except Exception as e:
+        logger.exception(f"Failed to process {patch_file}")
+        error = f"{type(e).__name__}: {e}"
+
+    return patch_file, skipped, error, time.perf_counter() - start
+
+
+def find_patch_files(work_dir: str, pattern: str = "patches_*.nc") -> list[str]:
+    """Find all patch files in the working directory matching a glob pattern
+
+    Parameters
+    ----------
+    work_dir : str
+        Working directory
+    pattern : str, default: 'patches_*.nc'
+        Glob pattern, relative to the working directory
+
+    Returns
+    -------
+    list
+        Sorted list of patch file names relative to the working directory
+    """
+
+    paths = glob.glob(os.path.join(work_dir, pattern))
+
+    return sorted(os.path.relpath(path, work_dir) for path in paths)
+
+
+@click.command()
+@click.option(
+    "-w", "--work_dir", default="/net/thermo/atmosdyn/maxibo/intexseas/webpage/"
+)
+@click.option("-g", "--pattern", default="patches_*.nc")
+@click.option("-n", "--workers", default=os.cpu_count(), type=int)
+@click.option("-j", "--year_workers", default=1, type=int)
+@click.option("--wrap/--no-wrap", default=True)
+@click.option("-a", "--min_area", default=100000, type=float)
+@click.option("-b", "--block_years", default=1, type=int)
+@click.option("-t", "--tile_size", default=TILE_SIZE, type=int)
+@click.option("-f", "--force", is_flag=True, default=False)
+@click.option("--profile", is_flag=True, default=False)
+def batch_patches(
+    work_dir: str = "/ytpool/data/ETH/INTEXseas/",
+    pattern: str = "patches_*.nc",
+    workers: int | None = None,
+    year_workers: int = 1,
+    wrap: bool = True,
+    min_area: float = 100000,
+    block_years: int = 1,
+    tile_size: int = TILE_SIZE,
+    force: bool = False,
+    profile: bool = False,
+) -> None:
+    """Process all patch files in a directory in parallel
+
+    Every file matching `pattern` is processed as with `update_patches`, with
+    files spread across a pool of worker processes. Success, failure and wall
+    time are reported for each file, and the command exits with a non-zero
+    status if any file failed.
+
+    Parameters
+    ----------
+    work_dir : str
+        Working directory
+    pattern : str, default: 'patches_*.nc'
+        Glob pattern selecting the files to process
+    workers : int, default: number of CPUs
+        Number of worker processes
+    year_workers : int, default: 1
+        Number of worker processes used by each file to extract contours of
+        different years, in addition to `workers`
+    wrap : bool, default: True
+        Polygonize the grid once and stitch objects across the date-line instead
+        of tripling the domain with `extend_domain`
+    min_area : float, default: 100000
+        Patches with an area (km^2) smaller than this are discarded
+    block_years : int, default: 1
+        Number of years read into memory at once
+    tile_size : int, default: TILE_SIZE
+        Number of grid points per tile and direction, 0 to disable tiling
+    force : bool, default: False
+        Process all catalogues even if no input changed
+    profile : bool, default: False
+        Write a JSON report with timings, memory and object counts per stage
+        next to each GeoJSON file
+
+    Examples
+    --------
+
+    >>> exseas-preproc batch -w /ytpool/data/ETH/INTEXseas/ -n 16
+    """
+
+    patch_files = find_patch_files(work_dir, pattern)
+    if not patch_files:
+        raise click.ClickException(f"No files matching {pattern} in {work_dir}")
+
+    logger.info(f"Processing {len(patch_files)} files with {workers} workers")
+    start = time.perf_counter()
+    failed = []
+    options = {
+        "year_workers": year_workers,
+        "wrap": wrap,
+        "min_area": min_area,
+        "block_years": block_years,
+        "tile_size": tile_size,
+        "force": force,
+        "profile": profile,
+    }
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(_process_worker, work_dir, patch_file, options)
+            for patch_file in patch_files
+        ]
+        for future in as_completed(futures):
+            patch_file, skipped, error, elapsed = future.result()
+            if skipped:
+                logger.info(f"SKIPPED {patch_file} ({elapsed:.1f}s)")
+            elif error is None:
+                logger.info(f"OK      {patch_file} ({elapsed:.1f}s)")
+            else:
+                logger.error(f"FAILED  {patch_file} ({elapsed:.1f}s): {error}")
+                failed.append(patch_file)
+
+    logger.info(
+        f"Processed {len(patch_files) - len(failed)}/{len(patch_files)} files "
+        f"in {time.perf_counter() - start:.1f}s"
+    )
+
+    if failed:
+        raise click.ClickException(f"{len(failed)} files failed: {', '.join(failed)}")
+
+
+@click.group()
+def cli() -> None:
+    """Pre-processing of extreme season patches"""
+
+
+cli.add_command(update_patches, name="update")
+cli.add_command(batch_patches, name="batch")
+
+
 if __name__ == "__main__":
     update_patches()
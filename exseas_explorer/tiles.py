@@ -0,0 +1,326 @@
+"""
+Mapbox Vector Tiles of extreme season patch catalogues
+
+Tiles are generated on demand from the catalogues and cached on disk, using the
+geometries simplified for the zoom level of each tile.
+"""
+
+import contextlib
+import functools
+import hashlib
+import math
+import os
+import struct
+from collections.abc import Collection
+
+import geopandas
+import numpy as np
+import shapely
+
+from exseas_explorer.cache import DiskBudget
+from exseas_explorer.catalogue import zoom_level
+from exseas_explorer.util import attach_geometries, catalogue_version, load_attributes
+
+# Size of a tile in tile coordinates and buffer around it, as used by Mapbox
+EXTENT = 4096
+BUFFER = 64
+MAX_ZOOM = 10
+LAYER_NAME = "patches"
+
+# Budget of the tile cache on disk, the oldest tiles are removed beyond it
+CACHE_BYTES = 2**30
+
+# Attributes of patches stored in the tiles
+PROPERTIES = [
+    "label",
+    "year",
+    "area",
+    "land_area",
+    "mean_ano",
+    "land_mean_ano",
+    "integrated_ano",
+    "land_integrated_ano",
+]
+
+# Maximum latitude of the Web Mercator projection
+MAX_LATITUDE = math.degrees(math.atan(math.sinh(math.pi)))
+
+
+def _varint(value: int) -> bytes:
+    out = bytearray()
+    while value > 0x7F:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def _zigzag(value: int) -> int:
+    return (value << 1) ^ (value >> 63)
+
+
+def _field(number: int, payload: bytes) -> bytes:
+    # Length-delimited field (wire type 2)
+    return _varint(number << 3 | 2) + _varint(len(payload)) + payload
+
+
+def _packed(number: int, values: list[int]) -> bytes:
+    return _field(number, b"".join(_varint(value) for value in values))
+
+
+def _value(value: int | float) -> bytes:
+    if isinstance(value, int):
+        # sint_value
+        return _varint(6 << 3) + _varint(_zigzag(value))
+    # double_value (wire type 1)
+    return _varint(3 << 3 | 1) + struct.pack("<d", value)
+
+
+def _command(command: int, count: int) -> int:
+    return command & 0x7 | count << 3
+
+
+def encode_geometry(geometry: shapely.Geometry) -> list[int]:
+    """
+    Encode a polygon or multipolygon in tile coordinates as geometry commands
+
+    Parameters
+    ----------
+    geometry : shapely.Geometry
+        Polygon with integer coordinates and exterior rings of positive area
+
+    Returns
+    -------
+    list
+        Commands and zigzag encoded parameters
+    """
+
+    commands = []
+    cursor = (0, 0)
+
+    for polygon in shapely.get_parts(geometry):
+        if not isinstance(polygon, shapely.Polygon):
+            continue
+        rings = [polygon.exterior, *polygon.interiors]
+        for ring in rings:
+            # The closing point is implied by the ClosePath command
+            coords = np.asarray(ring.coords, dtype=np.int64)[:-1]
+            if len(coords) < 3:
+                continue
+
+            for i, (x, y) in enumerate(coords):
+                if i == 0:
+                    commands.append(_command(1, 1))
+                elif i == 1:
+                    commands.append(_command(2, len(coords) - 1))
+                commands.append(_zigzag(int(x) - cursor[0]))
+                commands.append(_zigzag(int(y) - cursor[1]))
+                cursor = (int(x), int(y))
+
+            commands.append(_command(7, 1))
+
+    return commands
+
+
+def encode_tile(patches: geopandas.GeoDataFrame) -> bytes:
+    """
+    Encode patches in tile coordinates as a Mapbox Vector Tile with a single layer
+
+    Parameters
+    ----------
+    patches : geopandas.GeoDataFrame
+        Patches with geometries in tile coordinates
+
+    Returns
+    -------
+    bytes
+        Protocol buffer of the tile
+    """
+
+    keys = [column for column in PROPERTIES if column in patches]
+    values: dict[int | float, int] = {}
+    features = []
+
+    for row in patches.itertuples(index=False):
+        geometry = encode_geometry(row.geometry)
+        if not geometry:
+            continue
+
+        tags = []
+        for i, key in enumerate(keys):
+            value = getattr(row, key)
+            if value is None or np.isnan(value):
+                continue
+            value = int(value) if float(value).is_integer() else float(value)
+            tags += [i, values.setdefault(value, len(values))]
+
+        feature = _varint(1 << 3) + _varint(int(row.label))
+        feature += _packed(2, tags)
+        feature += _varint(3 << 3) + _varint(3)  # POLYGON
+        feature += _packed(4, geometry)
+        features.append(_field(2, feature))
+
+    layer = _varint(15 << 3) + _varint(2)
+    layer += _field(1, LAYER_NAME.encode())
+    layer += b"".join(features)
+    layer += b"".join(_field(3, key.encode()) for key in keys)
+    layer += b"".join(_field(4, _value(value)) for value in values)
+    layer += _varint(5 << 3) + _varint(EXTENT)
+
+    return _field(3, layer)
+
+
+def tile_bounds(z: int, x: int, y: int) -> tuple[float, float, float, float]:
+    """
+    Longitude and latitude bounds of a tile including its buffer
+
+    Parameters
+    ----------
+    z, x, y : int
+        Zoom level and index of the tile
+
+    Returns
+    -------
+    tuple
+        West, south, east and north bounds in degrees
+    """
+
+    n = 2**z
+    margin = BUFFER / EXTENT
+
+    def latitude(row: float) -> float:
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * row / n))))
+
+    west = (x - margin) / n * 360 - 180
+    east = (x + 1 + margin) / n * 360 - 180
+    north = latitude(max(y - margin, 0))
+    south = latitude(min(y + 1 + margin, n))
+
+    return west, south, east, north
+
+
+def render_tile(
+    patches: geopandas.GeoDataFrame, z: int, x: int, y: int
+) -> geopandas.GeoDataFrame:
+    """
+    Clip patches to a tile and project them to its tile coordinates
+
+    Parameters
+    ----------
+    patches : geopandas.GeoDataFrame
+        Patches in longitude and latitude
+    z, x, y : int
+        Zoom level and index of the tile
+
+    Returns
+    -------
+    geopandas.GeoDataFrame
+        Patches intersecting the tile, in integer tile coordinates
+    """
+
+    n = 2**z
+    geometries = shapely.clip_by_rect(patches.geometry.values, *tile_bounds(z, x, y))
+
+    def project(coords: np.ndarray) -> np.ndarray:
+        lon = coords[:, 0]
+        lat = np.radians(np.clip(coords[:, 1], -MAX_LATITUDE, MAX_LATITUDE))
+        col = (lon + 180) / 360 * n - x
+        row = (1 - np.arcsinh(np.tan(lat)) / np.pi) / 2 * n - y
+        return np.column_stack([col, row]) * EXTENT
+
+    geometries = shapely.transform(geometries, project)
+    geometries = shapely.set_precision(geometries, grid_size=1)
+    # Exterior rings must have a positive area in tile coordinates
+    geometries = shapely.orient_polygons(geometries)
+
+    keep = ~shapely.is_empty(geometries)
+    return patches[keep].assign(geometry=geometries[keep])
+
+
+@functools.cache
+def tile_budget(cache_dir: str, cache_bytes: int) -> DiskBudget:
+    """
+    Budget of a tile cache, shared by all threads of this process
+
+    Parameters
+    ----------
+    cache_dir : str
+        Directory in which generated tiles are cached
+    cache_bytes : int
+        Budget of the tile cache in bytes
+
+    Returns
+    -------
+    DiskBudget
+        Budget of the tile cache
+    """
+
+    return DiskBudget(cache_dir, cache_bytes, suffix=".pbf")
+
+
+def load_tile(
+    path: str,
+    z: int,
+    x: int,
+    y: int,
+    labels: Collection[int] | None = None,
+    cache_dir: str | None = None,
+    cache_bytes: int = CACHE_BYTES,
+) -> bytes:
+    """
+    Load a tile of a catalogue, from the tile cache if it was generated before
+
+    Labels that are not in the catalogue are ignored, so that clients cannot add
+    entries to the cache with made-up selections.
+
+    Parameters
+    ----------
+    path : str
+        Path to the GeoJSON file of the catalogue
+    z, x, y : int
+        Zoom level and index of the tile
+    labels : collection of int, optional
+        Labels of the patches included in the tile, all patches if not given
+    cache_dir : str, optional
+        Directory in which generated tiles are cached
+    cache_bytes : int, default: CACHE_BYTES
+        Budget of the tile cache in bytes
+
+    Returns
+    -------
+    bytes
+        Protocol buffer of the tile
+    """
+
+    patches = load_attributes(path)
+    selection = None
+    if labels:
+        patches = patches[patches["label"].isin(labels)]
+        selection = [int(label) for label in sorted(patches["label"])]
+
+    if cache_dir is not None:
+        # Replacing the catalogue or changing the selection changes the key
+        version = repr((catalogue_version(path), selection))
+        key = hashlib.sha1(version.encode()).hexdigest()[:16]
+        stem = os.path.splitext(os.path.basename(path))[0]
+        tile_path = os.path.join(cache_dir, stem, key, str(z), str(x), f"{y}.pbf")
+        if os.path.isfile(tile_path):
+            with open(tile_path, "rb") as in_file:
+                return in_file.read()
+
+    patches = attach_geometries(patches, path, zoom_level(z))
+    tile = encode_tile(render_tile(patches, z, x, y))
+
+    if cache_dir is not None:
+        # Write atomically, other workers may read the tile at the same time. The
+        # directory may be removed by another worker pruning the cache, in which
+        # case the tile is not cached.
+        tmp_path = f"{tile_path}.{os.getpid()}.tmp"
+        with contextlib.suppress(FileNotFoundError):
+            os.makedirs(os.path.dirname(tile_path), exist_ok=True)
+            with open(tmp_path, "wb") as out_file:
+                out_file.write(tile)
+            os.replace(tmp_path, tile_path)
+            tile_budget(cache_dir, cache_bytes).add(len(tile))
+
+    return tile
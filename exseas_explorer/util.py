@@ -1,16 +1,236 @@
-import functools
-from typing import Any
+from __future__ import annotations
+
+import hashlib
+import logging
+import os
+import pickle
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import TYPE_CHECKING, Any
 
 import dash_ag_grid
 import dash_leaflet as dl
-import geopandas
-import matplotlib
-import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
 from dash import html
 from geojson import Feature, FeatureCollection, Polygon
 
+from exseas_explorer.cache import (
+    CatalogueCache,
+    file_signature,
+    private_directory,
+    read_private,
+    write_private,
+)
+from exseas_explorer.catalogue import (
+    ZOOM_LEVELS,
+    ColumnStore,
+    encode_features,
+    read_catalogue,
+    read_simplified,
+)
+
+# Geometry and plotting libraries are slow to import and only imported when needed
+if TYPE_CHECKING:
+    import geopandas
+
+logger = logging.getLogger(__name__)
+
+# Catalogues loaded by this process, bounded to 1 GiB by default
+CATALOGUE_CACHE = CatalogueCache(max_bytes=2**30)
+
+
+# Column ranking patches for each criterion and whether its magnitude is ranked
+CRITERIA = {
+    1: ("area", False),
+    2: ("land_area", False),
+    3: ("mean_ano", True),
+    4: ("land_mean_ano", True),
+    5: ("integrated_ano", True),
+    6: ("land_integrated_ano", True),
+}
+
+
+def ranking_key(
+    df: pd.DataFrame, criterion: int, mask: np.ndarray | None = None
+) -> np.ndarray:
+    """
+    Values by which patches are ranked for a criterion, the largest first
+
+    Parameters
+    ----------
+    df : DataFrame
+        Patches
+    criterion : int
+        Criterion used to rank patches
+    mask : numpy.ndarray, optional
+        Patches to rank, all patches if not given
+
+    Returns
+    -------
+    numpy.ndarray
+        Ranking values, NaN for patches that cannot be ranked or are not selected
+    """
+
+    column, absolute = CRITERIA[criterion]
+    values = df[column].to_numpy(dtype=float)
+
+    # Single allocation, patches outside of the mask are left NaN
+    key = np.full(len(values), np.nan)
+    where = True if mask is None else mask
+    if absolute:
+        np.abs(values, out=key, where=where)
+    else:
+        np.copyto(key, values, where=where)
+    return key
+
+
+def top_k(values: np.ndarray, k: int) -> np.ndarray:
+    """
+    Positions of the `k` largest values, ignoring NaN
+
+    Ties are broken by position, so exactly `k` positions are returned unless
+    fewer values are available.
+
+    Parameters
+    ----------
+    values : numpy.ndarray
+        Values to rank
+    k : int
+        Number of values to select
+
+    Returns
+    -------
+    numpy.ndarray
+        Positions of the largest values, in no particular order
+    """
+
+    missing = np.isnan(values)
+    if missing.any():
+        positions = np.flatnonzero(~missing)
+        values = values[positions]
+    else:
+        positions = np.arange(len(values))
+
+    if k >= len(values):
+        return positions
+    if k <= 0:
+        return positions[:0]
+
+    # Partial selection of the k-th largest value, without sorting all values
+    threshold = np.partition(values, len(values) - k)[len(values) - k]
+
+    greater = positions[values > threshold]
+    equal = positions[values == threshold][: k - len(greater)]
+    return np.concatenate([greater, equal])
+
+
+def ranking_order(df: pd.DataFrame, criterion: int) -> np.ndarray:
+    """
+    Positions of patches ranked by a criterion, the most intense first
+
+    Ties are broken by position as in `top_k`.
+
+    Parameters
+    ----------
+    df : DataFrame
+        Patches
+    criterion : int
+        Criterion used to rank patches
+
+    Returns
+    -------
+    numpy.ndarray
+        Positions of all patches that can be ranked
+    """
+
+    key = ranking_key(df, criterion)
+    order = np.argsort(-key, kind="stable")
+
+    # NaN are sorted last
+    return order[: np.count_nonzero(~np.isnan(key))]
+
+
+def in_ranges(
+    df: pd.DataFrame,
+    ranges: list[tuple[str, list[float]]],
+    positions: np.ndarray | None = None,
+) -> np.ndarray:
+    """
+    Mask of patches whose attributes lie within ranges
+
+    Parameters
+    ----------
+    df : DataFrame
+        Patches
+    ranges : list of tuple
+        Columns and their lower and upper bounds
+    positions : numpy.ndarray, optional
+        Positions of the patches to test, all patches if not given
+
+    Returns
+    -------
+    numpy.ndarray
+        Mask of the patches within all ranges
+    """
+
+    mask = np.ones(len(df) if positions is None else len(positions), dtype=bool)
+    for column, (lower, upper) in ranges:
+        values = df[column].to_numpy()
+        if positions is not None:
+            values = values[positions]
+        mask &= values >= lower
+        mask &= values <= upper
+
+    return mask
+
+
+def walk_ranking(
+    df: pd.DataFrame,
+    order: np.ndarray,
+    nvals: int,
+    ranges: list[tuple[str, list[float]]],
+) -> np.ndarray:
+    """
+    Walk down the ranking of patches until `nvals` patches within ranges are found
+
+    The ranking is tested in blocks of growing size, so that the cost depends on
+    how far down the ranking the selected patches are, not on the number of
+    patches.
+
+    Parameters
+    ----------
+    df : DataFrame
+        Patches
+    order : numpy.ndarray
+        Positions of patches as returned by `ranking_order`
+    nvals : int
+        Number of patches to select
+    ranges : list of tuple
+        Columns and their lower and upper bounds
+
+    Returns
+    -------
+    numpy.ndarray
+        Positions of the selected patches, most intense first
+    """
+
+    selected = []
+    found = 0
+    start = 0
+    size = max(4 * nvals, 256)
+
+    while found < nvals and start < len(order):
+        block = order[start : start + size]
+        hits = block[in_ranges(df, ranges, block)][: nvals - found]
+        selected.append(hits)
+        found += len(hits)
+        start += size
+        size *= 2
+
+    return np.concatenate(selected) if selected else order[:0]
+
 
 def filter_patches(
     df: geopandas.GeoDataFrame,
@@ -19,6 +239,7 @@ def filter_patches(
     lon_range: list[float] = [-180, 180],
     lat_range: list[float] = [-90, 90],
     year_range: list[float] = [1950, 2020],
+    order: np.ndarray | None = None,
 ) -> tuple[geopandas.GeoDataFrame, str]:
     """
     Filter patches
@@ -37,6 +258,9 @@ def filter_patches(
         List of latitude range
     year_range : list, default: [1950, 2020]
         List of year range
+    order : numpy.ndarray, optional
+        Precomputed ranking of the patches for the criterion, as returned by
+        `ranking_order`
 
     Returns
     -------
@@ -44,15 +268,23 @@ def filter_patches(
         Filtered dataframe with the `nvals` most intense events
     """
 
-    # Filter for coordinate
-    df = df[(df["lonmean"] >= lon_range[0]) & (df["lonmean"] <= lon_range[1])]
-    df = df[(df["latmean"] >= lat_range[0]) & (df["latmean"] <= lat_range[1])]
+    ranges = [("lonmean", lon_range), ("latmean", lat_range), ("year", year_range)]
 
-    # Filter for years
-    df = df[(df["year"] >= year_range[0]) & (df["year"] <= year_range[1])]
+    if order is None:
+        # Select patches by coordinate and year in a single mask, so that only
+        # the patches finally selected are copied
+        mask = in_ranges(df, ranges)
+
+        # Rank by the criterion, patches without a value over land cannot be ranked
+        key = ranking_key(df, criterion, mask)
+        positions = top_k(key, nvals)
+        available_events = int(np.count_nonzero(~np.isnan(key)))
+    else:
+        # The walk stops after nvals patches, fewer are only found if fewer exist
+        positions = walk_ranking(df, order, nvals, ranges)
+        available_events = len(positions)
 
     # Check if the resulting number of events is still larger than nvals, otherwise change it
-    available_events = len(df)
 
     if available_events < nvals:
         nvals = available_events
@@ -62,43 +294,23 @@ def filter_patches(
 
     # Catch situations where no events remain
     if nvals == 0:
+        import geopandas
+
         df = geopandas.GeoDataFrame()
     else:
-        # Filter for criterion and number of values
-        if criterion == 1:
-            df = df[df["area"] >= np.sort(df["area"])[-nvals]]
-        elif criterion == 2:
-            # Remove instances where land_area is NAN
-            df = df[~np.isnan(df["land_area"])]
-            df = df[df["land_area"] >= np.sort(df["land_area"])[-nvals]]
-        elif criterion == 3:
-            df = df[np.abs(df["mean_ano"]) >= np.sort(np.abs(df["mean_ano"]))[-nvals]]
-        elif criterion == 4:
-            df = df[~np.isnan(df["land_mean_ano"])]
-            df = df[
-                np.abs(df["land_mean_ano"])
-                >= np.sort(np.abs(df["land_mean_ano"]))[-nvals]
-            ]
-        elif criterion == 5:
-            df = df[
-                np.abs(df["integrated_ano"])
-                >= np.sort(np.abs(df["integrated_ano"]))[-nvals]
-            ]
-        elif criterion == 6:
-            df = df[~np.isnan(df["land_integrated_ano"])]
-            df = df[
-                np.abs(df["land_integrated_ano"])
-                >= np.sort(np.abs(df["land_integrated_ano"]))[-nvals]
-            ]
+        # Keep the order of the catalogue
+        df = df.iloc[np.sort(positions)]
 
     return df, title
 
 
-@functools.cache
 def load_patches(path: str) -> geopandas.GeoDataFrame:
     """
     Load selected patches and return geopandas object with patches
 
+    A binary FlatGeobuf file next to the GeoJSON file is preferred if it exists.
+    Patches are kept in `CATALOGUE_CACHE` and reloaded when the files change.
+
     Parameters
     ----------
     path : str
@@ -111,12 +323,349 @@ def load_patches(path: str) -> geopandas.GeoDataFrame:
     """
 
     # Load data
-    in_file = open(path)
-    df = geopandas.read_file(in_file, engine="fiona")
+    stem = os.path.splitext(path)[0]
+    df = CATALOGUE_CACHE.get(
+        ("patches", path), [path, f"{stem}.fgb"], lambda: read_catalogue(path)
+    )
 
     return df
 
 
+def load_simplified(path: str, level: int) -> geopandas.GeoSeries:
+    """
+    Load simplified geometries of patches for a zoom level of the map
+
+    Parameters
+    ----------
+    path : str
+        Path to the GeoJSON file
+    level : int
+        Zoom level of the map
+
+    Returns
+    -------
+    geopandas.GeoSeries
+        Simplified geometries, indexed like the patches returned by `load_patches`
+    """
+
+    stem = os.path.splitext(path)[0]
+    paths = [path, f"{stem}.fgb", f"{stem}.simplified.fgb"]
+    return CATALOGUE_CACHE.get(
+        ("simplified", path, level), paths, lambda: read_simplified(path, level)
+    )
+
+
+def load_store(path: str) -> ColumnStore | None:
+    """
+    Map the columnar file of a catalogue, which is shared by all processes
+
+    Parameters
+    ----------
+    path : str
+        Path to the GeoJSON file
+
+    Returns
+    -------
+    ColumnStore or None
+        Columnar file of the catalogue, None if preprocessing did not write it
+    """
+
+    columns_path = os.path.splitext(path)[0] + ".columns.bin"
+
+    def load() -> ColumnStore | None:
+        return ColumnStore(columns_path) if os.path.isfile(columns_path) else None
+
+    return CATALOGUE_CACHE.get(("columns", path), [columns_path], load)
+
+
+def load_attributes(path: str) -> pd.DataFrame:
+    """
+    Load the attributes of patches used to filter them
+
+    Attributes are memory-mapped from the columnar file of the catalogue if it
+    exists, otherwise the patches are loaded with `load_patches`.
+
+    Parameters
+    ----------
+    path : str
+        Path to the GeoJSON file
+
+    Returns
+    -------
+    df : pandas.DataFrame
+        Attributes, indexed like the patches returned by `load_patches`
+    """
+
+    store = load_store(path)
+    if store is None:
+        return load_patches(path)
+
+    return store.attributes()
+
+
+def load_ranking(path: str, criterion: int) -> np.ndarray:
+    """
+    Load the ranking of patches for a criterion, computed once per catalogue
+
+    Parameters
+    ----------
+    path : str
+        Path to the GeoJSON file
+    criterion : int
+        Criterion used to rank patches
+
+    Returns
+    -------
+    numpy.ndarray
+        Positions of patches as returned by `ranking_order`
+    """
+
+    stem = os.path.splitext(path)[0]
+    paths = [path, f"{stem}.fgb", f"{stem}.columns.bin"]
+    return CATALOGUE_CACHE.get(
+        ("ranking", path, criterion),
+        paths,
+        lambda: ranking_order(load_attributes(path), criterion),
+    )
+
+
+def attach_geometries(
+    df: pd.DataFrame, path: str, level: int | None
+) -> geopandas.GeoDataFrame:
+    """
+    Add geometries and literature references to the attributes of patches
+
+    Parameters
+    ----------
+    df : DataFrame
+        Patches as returned by `load_attributes` or `filter_patches`
+    path : str
+        Path to the GeoJSON file the patches were loaded from
+    level : int or None
+        Zoom level as returned by `zoom_level`, None for full resolution
+
+    Returns
+    -------
+    df : GeoDataFrame
+        Patches with geometries simplified for the zoom level
+    """
+
+    import geopandas
+
+    store = load_store(path)
+
+    if level is not None:
+        simplified = load_simplified(path, level)
+        geometries, crs = simplified[df.index].values, simplified.crs
+    elif isinstance(df, geopandas.GeoDataFrame):
+        return df
+    elif store is not None:
+        geometries, crs = store.geometries(df.index), store.crs
+    else:
+        patches = load_patches(path)
+        geometries, crs = patches.geometry[df.index].values, patches.crs
+
+    if store is not None and not isinstance(df, geopandas.GeoDataFrame):
+        df = df.join(store.literature(df.index))
+
+    df = pd.DataFrame(df.drop(columns="geometry", errors="ignore"))
+    return geopandas.GeoDataFrame(df, geometry=geometries, crs=crs)
+
+
+def load_features(path: str, level: int | None) -> pd.Series:
+    """
+    Load the GeoJSON features of all patches of a catalogue, encoded once
+
+    Parameters
+    ----------
+    path : str
+        Path to the GeoJSON file
+    level : int or None
+        Zoom level as returned by `zoom_level`, None for full resolution
+
+    Returns
+    -------
+    pandas.Series
+        Encoded features, indexed like the patches returned by `load_attributes`
+    """
+
+    def load() -> pd.Series:
+        patches = attach_geometries(load_attributes(path), path, level)
+        # Popups show the year of patches under the name used by the table
+        return encode_features(patches.rename(columns={"year": "Year"}))
+
+    stem = os.path.splitext(path)[0]
+    paths = [path, f"{stem}.fgb", f"{stem}.simplified.fgb", f"{stem}.columns.bin"]
+    return CATALOGUE_CACHE.get(("features", path, level), paths, load)
+
+
+def feature_collection(path: str, labels: list[int] | None, level: int | None) -> bytes:
+    """
+    Assemble a GeoJSON feature collection of patches from their encoded features
+
+    Parameters
+    ----------
+    path : str
+        Path to the GeoJSON file
+    labels : list of int or None
+        Labels of the patches, in the order of the features, all patches if None
+    level : int or None
+        Zoom level as returned by `zoom_level`, None for full resolution
+
+    Returns
+    -------
+    bytes
+        UTF-8 encoded feature collection, unknown labels are left out
+    """
+
+    features = load_features(path, level)
+    if labels is None:
+        fragments = features.values
+    else:
+        rows = pd.Index(load_attributes(path)["label"]).get_indexer(labels)
+        fragments = features.values[rows[rows >= 0]]
+
+    return (
+        b'{"type": "FeatureCollection", "features": [' + b", ".join(fragments) + b"]}"
+    )
+
+
+def catalogue_version(path: str) -> tuple:
+    """
+    Version of the files of a catalogue and of this module, which changes
+    whenever results computed from the catalogue may change
+
+    Parameters
+    ----------
+    path : str
+        Path to the GeoJSON file
+
+    Returns
+    -------
+    tuple
+        Size and modification time of the files
+    """
+
+    stem = os.path.splitext(path)[0]
+    return file_signature(
+        [
+            path,
+            f"{stem}.fgb",
+            f"{stem}.simplified.fgb",
+            f"{stem}.columns.bin",
+            __file__,
+        ]
+    )
+
+
+def load_layout(path: str, level: int | None, cache_dir: str) -> dict[str, Any]:
+    """
+    Compute the initial selection shown on the map, or load it from disk
+
+    The default selection of a catalogue is cached on disk, keyed by the version
+    of the catalogue files and of this module, so that workers starting up do
+    not have to load the catalogue and its geometries. The selection is pickled,
+    so it is only read from a private directory and from files written by the
+    current user.
+
+    Parameters
+    ----------
+    path : str
+        Path to the GeoJSON file
+    level : int or None
+        Zoom level as returned by `zoom_level`, None for full resolution
+    cache_dir : str
+        Directory only accessible by the current user in which the selection is
+        cached
+
+    Returns
+    -------
+    dict
+        Patches as GeoJSON, colorscale, classes and table of the selection
+    """
+
+    version = repr((path, level, catalogue_version(path)))
+    key = hashlib.sha1(version.encode()).hexdigest()[:16]
+    cache_path = os.path.join(private_directory(cache_dir), f"layout_{key}.pkl")
+
+    try:
+        return pickle.loads(read_private(cache_path))
+    except (OSError, pickle.UnpicklingError, EOFError):
+        pass
+
+    patches, _ = filter_patches(load_attributes(path), order=load_ranking(path, 1))
+    classes = list(patches["label"])
+    colorscale = generate_cbar(list(patches["year"]))
+    table = generate_table(patches, colorscale, classes)
+    patches = attach_geometries(patches, path, level)
+
+    layout = {
+        "patches": patches.__geo_interface__,
+        "colorscale": colorscale,
+        "classes": classes,
+        "table": table,
+    }
+
+    # Written atomically, other workers may start up at the same time
+    write_private(cache_path, pickle.dumps(layout))
+
+    return layout
+
+
+def warm_up(paths: list[str], workers: int = 4) -> threading.Thread:
+    """
+    Load catalogues into `CATALOGUE_CACHE` on a background thread pool
+
+    The attributes, rankings and features encoded for each zoom level of each
+    catalogue are loaded, so that the first selection of a catalogue does not have to read its
+    files. Progress and timings are logged.
+
+    Parameters
+    ----------
+    paths : list of str
+        Paths to the GeoJSON files
+    workers : int, default: 4
+        Number of threads loading catalogues
+
+    Returns
+    -------
+    threading.Thread
+        Daemon thread reporting the progress, which ends once all catalogues
+        are loaded
+    """
+
+    def warm(path: str) -> float:
+        start = time.perf_counter()
+        load_attributes(path)
+        for criterion in CRITERIA:
+            load_ranking(path, criterion)
+        for level in ZOOM_LEVELS:
+            load_features(path, level)
+        return time.perf_counter() - start
+
+    def report() -> None:
+        start = time.perf_counter()
+        with ThreadPoolExecutor(workers, thread_name_prefix="warm-up") as executor:
+            futures = {executor.submit(warm, path): path for path in paths}
+            for done, future in enumerate(as_completed(futures), start=1):
+                name = os.path.basename(futures[future])
+                try:
+                    elapsed = future.result()
+                except Exception as e:
+                    logger.warning(f"Warm-up of {name} failed: {e}")
+                    continue
+                logger.info(
+                    f"Warmed up {name} in {elapsed:.2f} s ({done}/{len(paths)})"
+                )
+
+        elapsed = time.perf_counter() - start
+        logger.info(f"Warmed up {len(paths)} catalogues in {elapsed:.2f} s")
+
+    thread = threading.Thread(target=report, name="warm-up", daemon=True)
+    thread.start()
+    return thread
+
+
 def generate_cbar(labels: list[int]) -> dl.Colorbar:
     """
     Generate colorbar for provided year labels
@@ -131,6 +680,9 @@ def generate_cbar(labels: list[int]) -> dl.Colorbar:
     """
 
     # Define colors
+    import matplotlib
+    import matplotlib.pyplot as plt
+
     cmap = plt.get_cmap("nipy_spectral", len(labels))
     colors = [matplotlib.colors.to_hex(cmap(x)) for x in range(len(labels))]
 
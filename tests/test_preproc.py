@@ -1,11 +1,24 @@
+import json
 import os
+import shutil
 from pathlib import Path
 
 import geopandas as gpd
+import numpy as np
+import pytest
+import shapely
+import xarray as xr
 from click.testing import CliRunner
 from geopandas import testing
 
-from exseas_explorer.preproc.preproc import update_patches
+from exseas_explorer.catalogue import read_catalogue, read_simplified
+from exseas_explorer.preproc import preproc
+from exseas_explorer.preproc.preproc import (
+    batch_patches,
+    extend_domain,
+    extract_contours,
+    update_patches,
+)
 
 
 def test_update_patches():
@@ -30,5 +43,235 @@ def test_update_patches():
     test_patches = gpd.read_file(expected_path, engine="fiona")
     testing.assert_geodataframe_equal(generated_patches, test_patches)
 
-    # Delete the test file again
+    # Delete the test file, cached contours and manifest again
     os.remove(out_path)
+    os.remove(os.path.join(test_path, "patches_T2M_jja_ProbHot.contours.fgb"))
+    os.remove(os.path.join(test_path, "patches_T2M_jja_ProbHot.manifest.json"))
+    os.remove(os.path.join(test_path, "patches_T2M_jja_ProbHot.fgb"))
+    os.remove(os.path.join(test_path, "patches_T2M_jja_ProbHot.simplified.fgb"))
+    os.remove(os.path.join(test_path, "patches_T2M_jja_ProbHot.columns.bin"))
+
+
+def test_batch_patches():
+
+    test_path = os.path.abspath("tests/data")
+
+    runner = CliRunner()
+    result = runner.invoke(
+        batch_patches,
+        ["-w", test_path, "-g", "patches_*.nc", "-n", "2", "-b", "2", "-t", "100"],
+    )
+    assert result.exit_code == 0
+
+    out_path = os.path.join(test_path, "patches_T2M_jja_ProbHot.geojson")
+    generated_patches = gpd.read_file(out_path, engine="fiona")
+    expected_path = os.path.join(test_path, "patches_T2M_jja_ProbHot_test.geojson")
+    test_patches = gpd.read_file(expected_path, engine="fiona")
+    testing.assert_geodataframe_equal(generated_patches, test_patches)
+
+    os.remove(out_path)
+    os.remove(os.path.join(test_path, "patches_T2M_jja_ProbHot.contours.fgb"))
+    os.remove(os.path.join(test_path, "patches_T2M_jja_ProbHot.manifest.json"))
+    os.remove(os.path.join(test_path, "patches_T2M_jja_ProbHot.fgb"))
+    os.remove(os.path.join(test_path, "patches_T2M_jja_ProbHot.simplified.fgb"))
+    os.remove(os.path.join(test_path, "patches_T2M_jja_ProbHot.columns.bin"))
+
+    # No matching files is reported as an error
+    result = runner.invoke(batch_patches, ["-w", test_path, "-g", "missing_*.nc"])
+    assert result.exit_code != 0
+
+
+def test_extract_contours_parallel(test_file_netcdf):
+
+    label = xr.open_dataset(test_file_netcdf).label.rename({"time": "year"})
+    label = extend_domain(preproc.read_labels(label))
+
+    serial = extract_contours(label)
+    parallel = extract_contours(label, workers=2)
+    testing.assert_geodataframe_equal(serial, parallel)
+
+
+def test_extract_contours_wrap(test_file_netcdf):
+
+    label = xr.open_dataset(test_file_netcdf).label.rename({"time": "year"})
+    label = preproc.read_labels(label)
+
+    extended = extract_contours(extend_domain(label)).dissolve(by="label")
+    wrapped = extract_contours(label, wrap=True).dissolve(by="label")
+    testing.assert_geodataframe_equal(extended, wrapped)
+
+
+def test_extract_contours_open_grid(test_file_netcdf):
+
+    label = xr.open_dataset(test_file_netcdf).label.rename({"time": "year"})
+    label = preproc.read_labels(label)
+    closed = extract_contours(label, wrap=True).dissolve(by="label")
+
+    # Grids not repeating their first longitude, such as ERA5 grids
+    open_grid = label.isel(lon=slice(0, -1))
+    extended = extend_domain(open_grid)
+    assert np.allclose(np.diff(extended.lon.values), 0.5)
+    testing.assert_geodataframe_equal(
+        extract_contours(extended).dissolve(by="label"),
+        extract_contours(open_grid, wrap=True).dissolve(by="label"),
+    )
+
+    # Starting at 0 degrees, the same patches are found
+    rolled = open_grid.roll(lon=360, roll_coords=True)
+    rolled = rolled.assign_coords(lon=rolled.lon % 360)
+    wrapped = extract_contours(rolled, wrap=True).dissolve(by="label")
+    world = shapely.box(-180, -90, 180, 90)
+    difference = shapely.symmetric_difference(
+        shapely.intersection(closed.geometry.values, world),
+        shapely.intersection(wrapped.geometry.values, world),
+    )
+    assert np.allclose(shapely.area(difference), 0)
+
+    # Grids not spanning the globe are refused
+    with pytest.raises(ValueError):
+        extend_domain(label.isel(lon=slice(0, -5)))
+    with pytest.raises(ValueError):
+        extract_contours(label.isel(lon=slice(0, -5)), wrap=True)
+
+
+@pytest.fixture
+def work_dir(tmp_path):
+    test_path = os.path.abspath("tests/data")
+    for name in [
+        "patches_T2M_jja_ProbHot.nc",
+        "list_T2M_jja_Hot.txt",
+        "lit_T2M_jja_Hot.txt",
+    ]:
+        shutil.copy(os.path.join(test_path, name), tmp_path)
+    yield tmp_path
+
+
+def test_update_patches_incremental(work_dir, monkeypatch):
+
+    tmp_path = work_dir
+    patch_file = "patches_T2M_jja_ProbHot.nc"
+    first = preproc.process_patches(str(tmp_path), patch_file)
+    assert first is not None
+    assert (tmp_path / "patches_T2M_jja_ProbHot.manifest.json").is_file()
+
+    # Unchanged inputs are skipped
+    assert preproc.process_patches(str(tmp_path), patch_file) is None
+
+    def fail(*args, **kwargs):
+        raise AssertionError("contours should not be extracted again")
+
+    # A change of the literature only repeats the merge step
+    monkeypatch.setattr(preproc, "extract_contours", fail)
+    lit_path = tmp_path / "lit_T2M_jja_Hot.txt"
+    lines = lit_path.read_text().splitlines(keepends=True)
+    lit_path.write_text("".join(lines[:2]))
+    patches = preproc.process_patches(str(tmp_path), patch_file)
+    assert patches is not None
+    assert patches["author"].notna().sum() == 1
+
+    # Cached contours keep their geometries and column types
+    columns = ["label", "year", "area"]
+    assert (patches[columns].dtypes == first[columns].dtypes).all()
+    assert (patches[columns] == first[columns]).all(axis=None)
+    testing.assert_geoseries_equal(patches.geometry, first.geometry)
+
+    # Forcing a run extracts the contours again
+    monkeypatch.undo()
+    assert preproc.process_patches(str(tmp_path), patch_file, force=True) is not None
+
+
+def test_build_contours_min_area(test_file_netcdf):
+
+    list_path = os.path.join(os.path.dirname(test_file_netcdf), "list_T2M_jja_Hot.txt")
+
+    patches = preproc.build_contours(test_file_netcdf, list_path)
+    assert len(patches) == 19
+    assert (patches["area"] >= 100000).all()
+
+    large = preproc.build_contours(test_file_netcdf, list_path, min_area=1000000)
+    expected = patches[patches["area"] >= 1000000].reset_index(drop=True)
+    assert 0 < len(large) < len(patches)
+    testing.assert_geodataframe_equal(large, expected)
+
+
+def test_read_labels(test_file_netcdf):
+
+    assert preproc.label_dtype(255) == np.uint8
+    assert preproc.label_dtype(256) == np.uint16
+    assert preproc.label_dtype(70000) == np.int32
+
+    label = xr.open_dataset(test_file_netcdf).label
+    labels = preproc.read_labels(label, exclude=[568])
+    assert labels.dtype == np.uint16
+    assert not (labels == 568).any()
+    assert labels.max() == label.max()
+
+
+def test_polygonize_tiles(test_file_netcdf):
+
+    label = xr.open_dataset(test_file_netcdf).label.rename({"time": "year"})
+    label = preproc.read_labels(label)
+    affine = preproc.affine_transform(label)
+
+    def smoothed(labels, geometries):
+        geometries = preproc.smooth_geometries(geometries)
+        return sorted(zip(labels, (g.normalize().wkb for g in geometries)))
+
+    untiled = preproc.polygonize(label.values[0], affine, tile_size=0)
+    tiled = preproc.polygonize(label.values[0], affine, tile_size=100)
+    assert smoothed(*tiled) == smoothed(*untiled)
+
+    # Extended longitudes follow the input grid
+    extended = extend_domain(label)
+    assert extended.lon.values[0] == -540
+    assert extended.lon.values[-1] == 540
+    assert np.allclose(np.diff(extended.lon.values), 0.5)
+
+
+def test_update_patches_profile(work_dir):
+
+    preproc.process_patches(str(work_dir), "patches_T2M_jja_ProbHot.nc", profile=True)
+
+    with open(work_dir / "patches_T2M_jja_ProbHot.profile.json") as f:
+        report = json.load(f)
+
+    for name in [
+        "read_labels",
+        "polygonize",
+        "smooth",
+        "dissolve",
+        "write_geojson",
+        "write_fgb",
+        "simplify",
+        "write_simplified",
+        "write_columns",
+    ]:
+        assert report["stages"][name]["calls"] >= 1
+        assert report["stages"][name]["wall_time"] >= 0
+        assert report["stages"][name]["peak_memory"] > 0
+    assert report["counts"]["polygons_after_dissolve"] == 19
+    assert report["counts"]["vertices_written"] > 0
+
+
+def test_update_patches_binary(work_dir):
+
+    preproc.process_patches(str(work_dir), "patches_T2M_jja_ProbHot.nc")
+    assert (work_dir / "patches_T2M_jja_ProbHot.fgb").is_file()
+    assert (work_dir / "patches_T2M_jja_ProbHot.simplified.fgb").is_file()
+    assert (work_dir / "patches_T2M_jja_ProbHot.columns.bin").is_file()
+
+    # The binary catalogue is preferred and holds the same patches
+    geojson_path = str(work_dir / "patches_T2M_jja_ProbHot.geojson")
+    expected = gpd.read_file(geojson_path, engine="fiona")
+    patches = read_catalogue(geojson_path)
+    testing.assert_geodataframe_equal(
+        patches, expected, check_dtype=False, check_less_precise=True
+    )
+    assert patches.loc[patches["label"] == 584, "author"].iloc[0]["1"] == (
+        "Trenberth et al., 1988"
+    )
+
+    # Simplified geometries stored by preprocessing are indexed like the patches
+    simplified = read_simplified(geojson_path, 2)
+    assert len(simplified) == len(patches)
+    assert simplified.index.equals(patches.index)
@@ -0,0 +1,37 @@
+import os
+
+import geopandas as gpd
+import numpy as np
+
+from exseas_explorer.tiles import load_tile, tile_budget
+
+
+def test_load_tile(tmp_path):
+    path = os.path.abspath("tests/data/patches_T2M_jja_ProbHot_test.geojson")
+    cache_dir = tmp_path / "tiles"
+
+    # The world tile holds all patches, decoded here by the MVT driver of GDAL
+    tile_path = tmp_path / "0.pbf"
+    tile_path.write_bytes(load_tile(path, 0, 0, 0, cache_dir=str(cache_dir)))
+    patches = gpd.read_file(tile_path, engine="pyogrio")
+    assert len(patches) == 19
+    assert patches.geometry.is_valid.all()
+    assert np.all(patches["year"] == 1988)
+
+    # Selected labels are passed as a filter and tiles are cached per selection
+    tile = load_tile(path, 1, 0, 0, labels=[584], cache_dir=str(cache_dir))
+    tile_path.write_bytes(tile)
+    assert list(gpd.read_file(tile_path, engine="pyogrio")["label"]) == [584]
+    assert load_tile(path, 1, 0, 0, labels=[584], cache_dir=str(cache_dir)) == tile
+    assert len(list(cache_dir.rglob("*.pbf"))) == 2
+
+    # Unknown labels are ignored and the cache is pruned to its budget
+    unknown = load_tile(path, 1, 0, 0, [584, 1, 2], cache_dir=str(cache_dir))
+    assert unknown == tile
+    assert len(list(cache_dir.rglob("*.pbf"))) == 2
+    for label in range(568, 574):
+        load_tile(path, 0, 0, 0, [label], cache_dir=str(cache_dir), cache_bytes=1000)
+    assert sum(f.stat().st_size for f in cache_dir.rglob("*.pbf")) <= 1000
+
+    # The cache is only walked when the tiles written exceed the budget
+    assert tile_budget(str(cache_dir), 2**30).prunes == 1
@@ -1,12 +1,41 @@
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 import geojson
+import geopandas.testing
 import numpy as np
+import pandas as pd
 import pytest
+import shapely
 
+from exseas_explorer import util
+from exseas_explorer.cache import CatalogueCache, ResultCache
+from exseas_explorer.catalogue import (
+    ZOOM_LEVELS,
+    ColumnStore,
+    read_catalogue,
+    write_columns,
+    zoom_level,
+)
 from exseas_explorer.util import (
+    CATALOGUE_CACHE,
+    attach_geometries,
+    feature_collection,
     filter_patches,
     generate_cbar,
     generate_poly,
     generate_table,
+    load_attributes,
+    load_layout,
+    load_patches,
+    ranking_order,
+    top_k,
+    warm_up,
 )
 
 
@@ -64,3 +93,256 @@ def test_generate_poly():
     assert len(polygon.features) == 1
     assert polygon.features[0].geometry.coordinates[0][0] == [-180, 0]
     assert len(polygon.features[0].geometry.coordinates[0]) == 5
+
+
+def test_attach_geometries(filtered_patches):
+    path = os.path.abspath("tests/data/patches_T2M_jja_ProbHot_test.geojson")
+    assert zoom_level(2.5) == 2
+    assert zoom_level(4.75) == 4
+    assert zoom_level(5) is None
+    assert attach_geometries(filtered_patches, path, None) is filtered_patches
+
+    full = shapely.get_num_coordinates(filtered_patches.geometry.values).sum()
+    for level in ZOOM_LEVELS:
+        simplified = attach_geometries(filtered_patches, path, level)
+        assert list(simplified["label"]) == list(filtered_patches["label"])
+        assert shapely.is_valid(simplified.geometry.values).all()
+        assert shapely.get_num_coordinates(simplified.geometry.values).sum() < full
+
+
+def test_feature_collection(default_patches):
+    path = "tests/data/patches_T2M_jja_ProbHot_test.geojson"
+    labels = [584, 570, 1]
+    collection = json.loads(feature_collection(path, labels, 2))
+
+    patches = attach_geometries(default_patches.iloc[[16, 2]], path, 2)
+    expected = patches.rename(columns={"year": "Year"}).__geo_interface__
+    assert collection["features"] == json.loads(json.dumps(expected["features"]))
+
+    # All patches are sent for filtering in the browser
+    collection = json.loads(feature_collection(path, None, 2))
+    assert [f["properties"]["label"] for f in collection["features"]] == list(
+        default_patches["label"]
+    )
+
+
+def test_catalogue_cache(tmp_path):
+    path = tmp_path / "patches.geojson"
+    shutil.copy("tests/data/patches_T2M_jja_ProbHot_test.geojson", path)
+    cache = CatalogueCache(max_bytes=2**30)
+
+    def load():
+        return read_catalogue(str(path))
+
+    patches = cache.get("patches", [str(path)], load)
+    assert cache.get("patches", [str(path)], load) is patches
+    assert cache.stats()["hits"] == 1 and cache.stats()["misses"] == 1
+
+    # A replaced catalogue is reloaded
+    os.utime(path, ns=(0, 0))
+    assert cache.get("patches", [str(path)], load) is not patches
+    assert cache.stats()["misses"] == 2
+
+    # The least recently used catalogue is evicted to stay within the budget
+    cache.resize(int(cache.stats()["bytes"] * 1.5))
+    cache.get("other", [str(path)], load)
+    assert cache.stats()["evictions"] == 1
+    assert cache.stats()["entries"] == 1
+    assert cache.stats()["bytes"] <= cache.stats()["max_bytes"]
+
+
+def test_result_cache(tmp_path):
+    cache = ResultCache(str(tmp_path), memory_bytes=2**20, disk_bytes=2**20, ttl=60)
+    key = ResultCache.key("patches_T2M_jja_ProbHot", 10, (-180.0, 180.0))
+    assert key == ResultCache.key("patches_T2M_jja_ProbHot", 10, (-180.0, 180.0))
+
+    assert cache.get(key) is None
+    cache.put(key, {"features": [1, 2, 3]})
+    assert cache.get(key) == {"features": [1, 2, 3]}
+
+    # Other processes find results on disk
+    other = ResultCache(str(tmp_path), memory_bytes=2**20, disk_bytes=2**20, ttl=60)
+    assert other.get(key) == {"features": [1, 2, 3]}
+    assert cache.stats()["memory_hits"] == 1 and other.stats()["disk_hits"] == 1
+    assert cache.stats()["hit_rate"] == 0.5
+
+    # Expired results are not returned
+    path = tmp_path / f"{key}.pkl"
+    os.utime(path, (time.time() - 120, time.time() - 120))
+    other = ResultCache(str(tmp_path), memory_bytes=2**20, disk_bytes=2**20, ttl=60)
+    assert other.get(key) is None
+
+    # The oldest results are removed to stay within the disk budget
+    small = ResultCache(str(tmp_path), memory_bytes=0, disk_bytes=2000, ttl=60)
+    for i in range(5):
+        small.put(ResultCache.key(i), bytes(900))
+    assert sum(f.stat().st_size for f in tmp_path.iterdir()) <= 2000
+    assert small.get(ResultCache.key(4)) == bytes(900)
+    assert small.get(ResultCache.key(0)) is None
+
+    # The directory is only walked once a tenth of the budget was written
+    budget = ResultCache(str(tmp_path / "budget"), 0, disk_bytes=100_000, ttl=60)
+    for i in range(200):
+        budget.put(ResultCache.key(i), bytes(1000))
+    assert budget.disk.prunes <= 20
+    assert sum(f.stat().st_size for f in (tmp_path / "budget").iterdir()) <= 100_000
+
+
+def test_result_cache_private(tmp_path):
+    # Results are not read from directories or files other users can modify
+    shared = tmp_path / "shared"
+    shared.mkdir(mode=0o777)
+    shared.chmod(0o777)
+    with pytest.raises(PermissionError):
+        ResultCache(str(shared), memory_bytes=0, disk_bytes=2**20, ttl=60)
+
+    cache = ResultCache(str(tmp_path / "results"), 0, 2**20, 60)
+    assert (tmp_path / "results").stat().st_mode & 0o777 == 0o700
+    key = ResultCache.key("patches")
+    umask = os.umask(0o002)
+    try:
+        cache.put(key, [1, 2, 3])
+    finally:
+        os.umask(umask)
+    assert cache.get(key) == [1, 2, 3]
+    (tmp_path / "results" / f"{key}.pkl").chmod(0o666)
+    assert cache.get(key) is None
+
+
+def test_catalogue_cache_single_flight(tmp_path):
+    path = tmp_path / "patches.geojson"
+    path.touch()
+    cache = CatalogueCache(max_bytes=2**30)
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def load():
+        calls.append(1)
+        started.set()
+        release.wait(timeout=10)
+        return pd.DataFrame({"label": [1, 2]})
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        first = executor.submit(cache.get, "patches", [str(path)], load)
+        started.wait(timeout=10)
+        others = [
+            executor.submit(cache.get, "patches", [str(path)], load) for _ in range(3)
+        ]
+        # Wait for the other threads to join the load in progress
+        while cache.stats()["coalesced"] < 3:
+            time.sleep(0.01)
+        release.set()
+        results = [future.result() for future in [first, *others]]
+
+    assert len(calls) == 1
+    assert all(result is results[0] for result in results)
+    assert cache.stats()["misses"] == 1
+
+
+def test_load_attributes(tmp_path, default_patches):
+    path = tmp_path / "patches.geojson"
+    shutil.copy("tests/data/patches_T2M_jja_ProbHot_test.geojson", path)
+    write_columns(default_patches, str(tmp_path / "patches.columns.bin"))
+
+    # Attributes are read-only views of the memory-mapped columnar file
+    attributes = load_attributes(str(path))
+    assert not attributes["area"].to_numpy().flags.writeable
+    assert "geometry" not in attributes
+
+    filtered, _ = filter_patches(attributes)
+    patches = attach_geometries(filtered, str(path), None)
+    expected, _ = filter_patches(load_patches(str(path)))
+    geopandas.testing.assert_geodataframe_equal(patches, expected[patches.columns])
+
+
+def test_write_columns_replace(tmp_path, default_patches):
+    path = str(tmp_path / "patches.columns.bin")
+    write_columns(default_patches, path)
+    store = ColumnStore(path)
+
+    # Rewriting the file does not affect processes mapping the previous file
+    write_columns(default_patches.iloc[:5], path)
+    assert len(store.attributes()["area"]) == 19
+    assert store.attributes()["area"].sum() == default_patches["area"].sum()
+    assert len(ColumnStore(path).attributes()) == 5
+    assert os.listdir(tmp_path) == ["patches.columns.bin"]
+
+
+def test_warm_up(tmp_path, caplog):
+    path = tmp_path / "patches.geojson"
+    shutil.copy("tests/data/patches_T2M_jja_ProbHot_test.geojson", path)
+
+    with caplog.at_level(logging.INFO, logger="exseas_explorer.util"):
+        warm_up([str(path)], workers=2).join(timeout=60)
+    assert "Warmed up 1 catalogues" in caplog.text
+
+    # The catalogue is served from the cache afterwards
+    hits = CATALOGUE_CACHE.stats()["hits"]
+    load_attributes(str(path))
+    assert CATALOGUE_CACHE.stats()["hits"] == hits + 2
+
+
+def test_load_layout(tmp_path, monkeypatch):
+    path = os.path.abspath("tests/data/patches_T2M_jja_ProbHot_test.geojson")
+    umask = os.umask(0o002)
+    try:
+        layout = load_layout(path, 2, str(tmp_path))
+    finally:
+        os.umask(umask)
+    assert len(layout["patches"]["features"]) == 10
+    assert layout["classes"] == [
+        f["properties"]["label"] for f in layout["patches"]["features"]
+    ]
+    assert len(list(tmp_path.glob("layout_*.pkl"))) == 1
+
+    # Afterwards, the layout is loaded from disk without loading the catalogue
+    def fail(path):
+        raise AssertionError("catalogue loaded")
+
+    monkeypatch.setattr(util, "load_attributes", fail)
+    assert load_layout(path, 2, str(tmp_path))["classes"] == layout["classes"]
+
+    # The cached layout is private whatever the umask
+    (layout_path,) = tmp_path.glob("layout_*.pkl")
+    assert layout_path.stat().st_mode & 0o777 == 0o600
+
+
+def test_top_k():
+    values = np.array([3.0, np.nan, 5.0, 3.0, 1.0, 3.0, np.nan])
+    # Ties are broken by position and NaN are never selected
+    assert sorted(top_k(values, 2)) == [0, 2]
+    assert sorted(top_k(values, 3)) == [0, 2, 3]
+    assert sorted(top_k(values, 10)) == [0, 2, 3, 4, 5]
+    assert len(top_k(values, 0)) == 0
+
+    # Exactly nvals patches are selected, even with tied values
+    df = pd.DataFrame(
+        {
+            "lonmean": 0.0,
+            "latmean": 0.0,
+            "year": 2000,
+            "area": [1.0, 2.0, 2.0, 2.0],
+            "land_area": [np.nan, 2.0, np.nan, np.nan],
+        }
+    )
+    filtered, _ = filter_patches(df, criterion=1, nvals=2)
+    assert list(filtered.index) == [1, 2]
+    filtered, title = filter_patches(df, criterion=2, nvals=2)
+    assert list(filtered.index) == [1]
+    assert title == "Only 1 events in this selection:"
+
+
+def test_filter_patches_ranking(default_patches):
+    # Walking down a precomputed ranking selects the same patches
+    for criterion in range(1, 7):
+        order = ranking_order(default_patches, criterion)
+        for lon_range, nvals in [([-180, 180], 5), ([-50, 150], 3), ([0, 10], 5)]:
+            expected, expected_title = filter_patches(
+                default_patches, criterion, nvals, lon_range
+            )
+            filtered, title = filter_patches(
+                default_patches, criterion, nvals, lon_range, order=order
+            )
+            assert list(filtered.index) == list(expected.index)
+            assert title == expected_title